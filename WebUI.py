@@ -1,38 +1,195 @@
-from flask import Flask, render_template, jsonify
-import pandas as pd
+from flask import Flask, Response, render_template, jsonify, request
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import json
 import os
+import queue
+import threading
+import numpy as np
+from live_feed import LiveHub
+from downsample import downsample_indices
+from hr_log import EMOTIONS, PartitionedLog, emotion_labels
+from rollup import pick_interval, read_rollup
+from segments import SegmentTracker
 
 app = Flask(__name__)
 
-LOG_FILE = "emotion_log.csv"
+LOG_DIR = "logs"  # logs/<デバイス名>/<日時>.hrl（step1_get_heart_rate.py と同じ）
+JST = ZoneInfo("Asia/Tokyo")
+KEEPALIVE_SEC = 15
+DEFAULT_MAX_POINTS = 2000  # チャートの横幅（px）程度
+DEFAULT_MAX_SEGMENTS = 300  # 感情帯（annotation）の最大数
+RAW_SECONDS_PER_POINT = 10  # 1点あたりこの秒数以下の範囲なら生ログを間引く（それより長ければ集計を使う）
+
+
+def format_label(ts):
+    # JST変換（日本時間に変換して「月/日 時:分」形式で出力）
+    return datetime.fromtimestamp(ts, JST).strftime("%m/%d %H:%M")
+
+
+# ==== ログの読み出し ====
+class LogTail:
+    """時間パーティション化されたログから、必要な時間帯のファイルだけを読む"""
+
+    def __init__(self, directory):
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.log = PartitionedLog(directory)
+        self.segments = SegmentTracker()
+
+    def refresh(self):
+        """前回以降に追記された行で感情区間を伸ばす（生ログ自体は読み出し時に該当パーティションだけ読む）"""
+        with self.lock:
+            last = self.segments.last_ts
+            records = self.log.read_range(last)
+            if last is not None:
+                records = records[records["timestamp"] > last]
+            self.segments.extend(records["timestamp"], records["emotion"])
+
+    def _rows(self, records, cursor):
+        ts = records["timestamp"]
+        return {
+            "cursor": cursor,
+            "timestamps": ts.tolist(),
+            "labels": [format_label(t) for t in ts.tolist()],
+            "heart_rate": records["heart_rate"].tolist(),
+            # 表示用に小数2桁へ丸める（CSV時代と同じ精度）
+            "rmssd": np.round(records["rmssd"].astype(np.float64), 2).tolist(),
+            "emotion": emotion_labels(records["emotion"])
+        }
+
+    def since(self, cursor):
+        """cursor（UNIX秒）より後の行を返す。cursor が 0 以下なら全件"""
+        with self.lock:
+            reset = cursor <= 0
+            records = self.log.read_range(None if reset else cursor)
+            if not reset:
+                records = records[records["timestamp"] > cursor]
+            last = float(records["timestamp"][-1]) if len(records) else cursor
+            out = self._rows(records, last)
+            out["reset"] = reset
+            return out
+
+    def window(self, t_from=None, t_to=None, max_points=None, min_segment=0, max_segments=None):
+        """[t_from, t_to] の範囲を max_points 点以下で返す。
+        短い範囲は生ログを LTTB で間引き、長い範囲は足りる中で最も粗い集計（1分/5分/1時間）を使う。
+        感情帯は min_segment 秒未満の区間を吸収し、max_segments 個以下にまとめて返す"""
+        with self.lock:
+            lo = t_from if t_from is not None else self.log.earliest_timestamp()
+            hi = t_to if t_to is not None else self.log.latest_timestamp()
+            span = hi - lo if lo is not None and hi is not None else 0
+            cursor = self.log.latest_timestamp() or 0
+            if span <= max_points * RAW_SECONDS_PER_POINT:
+                records = self.log.read_range(t_from, t_to)
+                picked = downsample_indices(records["timestamp"],
+                                            [records["heart_rate"], records["rmssd"]], max_points)
+                out = self._rows(records[picked], cursor)
+                out["resolution"] = 0
+            else:
+                out = self._rollup_rows(pick_interval(span, max_points), t_from, t_to, max_points, cursor)
+            out["segments"], out["min_segment"] = self.segments.bounded(t_from, t_to, min_segment, max_segments)
+            out["reset"] = True
+            out["total"] = len(out["timestamps"])
+            return out
+
+    def _rollup_rows(self, interval, t_from, t_to, max_points, cursor):
+        records = read_rollup(self.directory, interval, t_from, t_to)
+        centers = records["start"] + interval / 2
+        picked = downsample_indices(centers, [records["hr_mean"], records["rmssd_mean"]], max_points)
+        records = records[picked]
+        centers = centers[picked]
+        dominant = np.argmax(records["emotion_counts"], axis=1) if len(records) else []
+        return {
+            "cursor": cursor,
+            "resolution": interval,
+            "timestamps": centers.tolist(),
+            "labels": [format_label(t) for t in centers.tolist()],
+            "heart_rate": np.round(records["hr_mean"].astype(np.float64), 1).tolist(),
+            "hr_min": records["hr_min"].tolist(),
+            "hr_max": records["hr_max"].tolist(),
+            "rmssd": np.round(records["rmssd_mean"].astype(np.float64), 2).tolist(),
+            # 区間内で最も多かった感情と内訳（EMOTIONS の順）
+            "emotion": [EMOTIONS[i] for i in dominant],
+            "emotion_counts": records["emotion_counts"].tolist()
+        }
+
+
+log_tails = {}
+log_tails_lock = threading.Lock()
+live_hub = LiveHub()
+
+
+def list_devices():
+    if not os.path.isdir(LOG_DIR):
+        return []
+    return sorted(d for d in os.listdir(LOG_DIR) if os.path.isdir(os.path.join(LOG_DIR, d)))
+
+
+def get_log_tail(device):
+    """デバイス名に対応する LogTail（未指定なら最初のデバイス）。存在しなければ None"""
+    devices = list_devices()
+    if device is None and devices:
+        device = devices[0]
+    if device not in devices:
+        return None
+    with log_tails_lock:
+        if device not in log_tails:
+            log_tails[device] = LogTail(os.path.join(LOG_DIR, device))
+        return log_tails[device]
+
 
 @app.route("/")
 def index():
     return render_template("index.html")
 
+@app.route("/devices")
+def devices():
+    return jsonify(list_devices())
+
 @app.route("/data")
 def data():
-    if not os.path.exists(LOG_FILE):
-        return jsonify([])
+    args = request.args
+    log_tail = get_log_tail(args.get("device"))
+    if log_tail is None:
+        return jsonify({"cursor": 0, "reset": True, "total": 0, "timestamps": [], "labels": [],
+                        "heart_rate": [], "rmssd": [], "emotion": [], "segments": [], "min_segment": 0})
+    log_tail.refresh()
+    if any(k in args for k in ("from", "to", "max_points")):
+        # 表示範囲の間引き取得（from/to は UNIX 秒）
+        max_points = args.get("max_points", default=DEFAULT_MAX_POINTS, type=int)
+        return jsonify(log_tail.window(args.get("from", type=float),
+                                       args.get("to", type=float),
+                                       max(max_points, 3),
+                                       args.get("min_segment", default=0, type=float),
+                                       args.get("max_segments", default=DEFAULT_MAX_SEGMENTS, type=int)))
+    cursor = args.get("cursor", default=0, type=float)
+    return jsonify(log_tail.since(cursor))
 
-    df = pd.read_csv(LOG_FILE, encoding="utf-8")
+@app.route("/stream")
+def stream():
+    """心拍取得スクリプトから届いたサンプルを Server-Sent Events でそのまま流す（?device= で絞り込み）"""
+    device = request.args.get("device") or next(iter(list_devices()), None)
+    # リローダーの親プロセスでポートを掴まないよう、最初の接続時に受信を開始する
+    live_hub.start()
+    q = live_hub.subscribe()
 
-    # JST変換（日本時間に変換して「月/日 時:分」形式で出力）
-    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s", utc=True)
-    df["timestamp"] = df["timestamp"].dt.tz_convert("Asia/Tokyo")
-    df["timestamp"] = df["timestamp"].dt.strftime("%m/%d %H:%M")
-
-    # 数値化・NaN対策
-    df["heart_rate"] = pd.to_numeric(df["heart_rate"], errors="coerce")
-    df["rmssd"] = pd.to_numeric(df["rmssd"], errors="coerce").fillna(0)
-
-    data = {
-        "labels": df["timestamp"].tolist(),
-        "heart_rate": df["heart_rate"].tolist(),
-        "rmssd": df["rmssd"].tolist(),
-        "emotion": df["emotion"].tolist()
-    }
-    return jsonify(data)
+    def events():
+        try:
+            while True:
+                try:
+                    sample = q.get(timeout=KEEPALIVE_SEC)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if device is not None and sample.get("device") != device:
+                    continue
+                sample = dict(sample, label=format_label(sample["timestamp"]))
+                yield f"data: {json.dumps(sample, ensure_ascii=False)}\n\n"
+        finally:
+            live_hub.unsubscribe(q)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0")
@@ -1,11 +1,12 @@
 import os
-import threading
-import time
 import random
-import numpy as np
-import sounddevice as sd
-import soundfile as sf
-from transformers import pipeline
+import traceback
+from audio_dsp import StageCrossfader, apply_fade, assemble, resample
+from preset_pool import PresetPool
+from segment_buffer import SegmentBuffer
+from session_clock import RealClock
+from audio_engine import PLAYBACK_RATE, AudioEngine, ShuffleSource, StreamSource
+from musicgen_server import PRIORITY_PLAYBACK, connect
 
 # ========== 設定 ==========
 emotions = ["relax", "uplift", "sad"]
@@ -15,7 +16,15 @@ loop_files = {
     "sad": ["output/loop_sad1.wav", "output/loop_sad2.wav"]
 }
 
-musicgen_pipe = pipeline("text-to-audio", model="facebook/musicgen-small",device=0)
+EMOTION_INTERVAL = 360  # 感情を切り替える間隔（秒）
+
+musicgen = None      # main() で connect()（推論サーバー python musicgen_server.py があればそれを使う）
+clock = RealClock()  # ヘッドレス再生（render_session.py --app app）では仮想時計に差し替わる
+timeline = []        # 再生中に起きたこと（{"t": 秒, "event": ...}）
+MUSICGEN_BATCH_SIZE = 5  # 全ステージを1バッチで生成（メモリ不足なら自動で小さくする）
+MUSICGEN_SEEDS = 4       # シードの候補数（同じプロンプト×シードの組はキャッシュから読む）
+STREAM_STAGES = True      # ステージが1つできるたびに再生キューへ送る（最初のAI曲までの待ちを1ステージ分に）
+STREAM_BATCH_SIZE = 1     # ストリーミング時のバッチサイズ
 
 # 「進化的プロンプト」構成：イントロ→盛り上がり→落ち着き…など
 progress_variants = {
@@ -58,87 +67,47 @@ def dynamic_progress_prompt(emotion, step, prev_keywords=None):
         prompt += ", " + prev_keywords
     return prompt
 
+def note(event, **info):
+    """タイムラインにイベントを記録する（t は clock の秒）"""
+    timeline.append({"t": round(clock.now(), 3), "event": event, **info})
+
 # ========== フェード・クロスフェード ==========
-def fade_in(data, fade_len=5000):
-    if data.dtype != np.float32 and data.dtype != np.float64:
-        data = data.astype(np.float32)
-    fade = np.linspace(0, 1, min(fade_len, len(data)))
-    data[:len(fade)] *= fade
-    return data
-
-def fade_out(data, fade_len=5000):
-    if data.dtype != np.float32 and data.dtype != np.float64:
-        data = data.astype(np.float32)
-    fade = np.linspace(1, 0, min(fade_len, len(data)))
-    data[-len(fade):] *= fade
-    return data
-
-def crossfade_segments(seg1, seg2, fade_len=5000):
-    seg1 = seg1.astype(np.float32)
-    seg2 = seg2.astype(np.float32)
-    fade_len = min(fade_len, len(seg1), len(seg2))
-    fade_out_curve = np.linspace(1, 0, fade_len)
-    fade_in_curve = np.linspace(0, 1, fade_len)
-    cross = seg1[-fade_len:] * fade_out_curve + seg2[:fade_len] * fade_in_curve
-    return np.concatenate([seg1[:-fade_len], cross, seg2[fade_len:]])
+CROSSFADE_SHAPE = "linear"  # "equal_power" にすると重なり中の音量が落ちない
 
 # ========== 進化型MusicGen生成 ==========（ここが進化！）
-def musicgen_generate_evolution(emotion, tokens=1024):
-    """進化的プロンプトで複数セグメント生成し連結。進化を感じる曲に！"""
+def evolution_prompts(emotion):
+    """進化的プロンプトをステージ分まとめて作る"""
     progress_list = progress_variants[emotion]
-    segs = []
-    rate = None
+    prompts = []
     prev_keywords = ""
     for idx, stage in enumerate(progress_list):
         prompt = dynamic_progress_prompt(emotion, idx, prev_keywords)
         print(f"MusicGen進化生成 {idx+1}/{len(progress_list)}: {prompt}")
-        audio = musicgen_pipe(prompt, forward_params={"do_sample": True, "max_new_tokens": tokens})
-        if isinstance(audio, list):
-            audio = audio[0]
-        audio_data = np.squeeze(audio["audio"])
-        audio_data = fade_in(audio_data)
-        audio_data = fade_out(audio_data)
-        if rate is None:
-            rate = audio["sampling_rate"]
-        segs.append(audio_data)
+        prompts.append(prompt)
         # 今回のextraキーワードを次回にも引き継ぐ（より有機的な進化へ）
         prev_keywords = ", ".join(random.sample(mood_base[emotion], 2))
-    # セグメントをcrossfadeで順につなぐ
-    full = segs[0]
-    for s in segs[1:]:
-        full = crossfade_segments(full, s)
-    return full, rate
+    return prompts
+
+def musicgen_stream_evolution(emotion, tokens=1024, batch_size=MUSICGEN_BATCH_SIZE):
+    """ステージごとに (再生レートにそろえたフェード済みセグメント, rate) を生成でき次第 yield する"""
+    for audio_data, rate in musicgen.iter_generate(evolution_prompts(emotion), tokens, batch_size,
+                                                   seed=random.randrange(MUSICGEN_SEEDS), priority=PRIORITY_PLAYBACK):
+        yield apply_fade(resample(audio_data, rate, PLAYBACK_RATE), 5000, CROSSFADE_SHAPE), PLAYBACK_RATE
+
+def musicgen_generate_evolution(emotion, tokens=1024):
+    """進化的プロンプトで複数セグメント生成し連結。進化を感じる曲に！"""
+    results = list(musicgen_stream_evolution(emotion, tokens))
+    segs = [seg for seg, _ in results]
+    rate = results[0][1]
+    # セグメントをcrossfadeで順につなぐ（1本のバッファへ直接書く）
+    return assemble(segs, 5000, CROSSFADE_SHAPE), rate
 
 # ========== 感情切り替え/バッファ/再生系（ここは前回のまま） ==========
 
 def get_current_emotion():
-    t = int(time.time() / 360) % len(emotions)
+    t = int(clock.now() / EMOTION_INTERVAL) % len(emotions)
     return emotions[t]
 
-class SegmentBuffer:
-    def __init__(self):
-        self.buffer = []
-        self.lock = threading.Lock()
-        self.emotion = get_current_emotion()
-        self.running = True
-        self.rate = None
-
-    def append(self, seg, rate):
-        with self.lock:
-            self.buffer.append(seg)
-            self.rate = rate
-
-    def pop(self):
-        with self.lock:
-            if self.buffer:
-                return self.buffer.pop(0)
-            else:
-                return None
-
-    def clear(self):
-        with self.lock:
-            self.buffer = []
-
 def background_generate(buffer: SegmentBuffer):
     while buffer.running:
         now_emotion = get_current_emotion()
@@ -146,67 +115,97 @@ def background_generate(buffer: SegmentBuffer):
             print(f"感情 {buffer.emotion}→{now_emotion} に切り替わりました（バッファ消去）")
             buffer.clear()
             buffer.emotion = now_emotion
+            note("emotion", emotion=now_emotion)
         print(f"新しい進化型AI曲を生成中...（emotion={buffer.emotion}）")
-        audio_data, rate = musicgen_generate_evolution(buffer.emotion, tokens=1024)
-        buffer.append(audio_data, rate)
-        time.sleep(2)
-
-def play_preset_bgm_crossfade_random(emotion, rate, fade_len=5000, stop_event=None):
-    file_list = loop_files[emotion]
-    last_idx = -1
-    play_rate = rate
-    while True:
-        idx_candidates = [i for i in range(len(file_list)) if i != last_idx]
-        idx = random.choice(idx_candidates)
-        data, bgm_rate = sf.read(file_list[idx])
-        if data.dtype != np.float32 and data.dtype != np.float64:
-            data = data.astype(np.float32)
-        if play_rate is None:
-            play_rate = bgm_rate
-        if last_idx != -1:
-            last_data, _ = sf.read(file_list[last_idx])
-            if last_data.dtype != np.float32 and last_data.dtype != np.float64:
-                last_data = last_data.astype(np.float32)
-            seg_cf = crossfade_segments(last_data, data, fade_len)
-        else:
-            seg_cf = fade_in(data, fade_len)
-            seg_cf = fade_out(seg_cf, fade_len)
-        sd.play(seg_cf, play_rate)
-        start = time.time()
-        duration = len(seg_cf) / play_rate
-        while time.time() - start < duration:
-            if stop_event and stop_event.is_set():
-                sd.stop()
-                return
-            time.sleep(0.1)
-        if stop_event and stop_event.is_set():
-            sd.stop()
+        note("generate", emotion=buffer.emotion)
+        try:
+            if STREAM_STAGES:
+                stream_evolution(buffer)
+            else:
+                audio_data, rate = musicgen_generate_evolution(buffer.emotion, tokens=1024)
+                buffer.put(audio_data, rate)
+        except Exception:
+            # 生成に失敗してもスレッドは止めない（その間はプリセットBGMが流れる）
+            print("=== AI曲生成で例外発生 ===")
+            print(traceback.format_exc())
+        clock.sleep(2)
+
+def stream_evolution(buffer: SegmentBuffer):
+    """ステージができるたびに、次のステージとの crossfade 分を残してバッファへ送る"""
+    emotion = buffer.emotion
+    crossfader = StageCrossfader(5000, CROSSFADE_SHAPE)
+    rate = None
+    for seg, rate in musicgen_stream_evolution(emotion, 1024, STREAM_BATCH_SIZE):
+        if get_current_emotion() != emotion:
+            # 感情が変わったら残りのステージは作らない
             return
-        last_idx = idx
+        buffer.put(crossfader.push(seg), rate)
+    if rate is not None:
+        buffer.put(crossfader.finish(), rate)
+
+def preset_source(emotion):
+    """その感情のプリセットループをランダム順に crossfade でつなぎ続ける音源（PCM はプールのものを使い回す）"""
+    return ShuffleSource(preset_pool.loops_for(loop_files[emotion]))
 
 os.makedirs("output", exist_ok=True)
-segment_buffer = SegmentBuffer()
-bg_thread = threading.Thread(target=background_generate, args=(segment_buffer,), daemon=True)
-bg_thread.start()
-
-try:
-    while True:
-        seg = segment_buffer.pop()
-        if seg is not None:
-            print(f"AI進化曲を再生（buffer残り={len(segment_buffer.buffer)}）")
-            sd.play(seg, segment_buffer.rate)
-            sd.wait()
-        else:
-            print("生成待ち→多曲ランダムクロスフェードBGM再生")
-            stop_event = threading.Event()
-            th = threading.Thread(target=play_preset_bgm_crossfade_random,
-                                  args=(get_current_emotion(), segment_buffer.rate, 5000, stop_event))
-            th.start()
-            while segment_buffer.pop() is None:
-                time.sleep(0.5)
-            stop_event.set()
-            th.join()
-except KeyboardInterrupt:
-    segment_buffer.running = False
-    sd.stop()
-    print("終了")
+
+def main(engine=None, session_clock=None, generator=None, duration=None):
+    """再生ループ。engine・session_clock・generator を渡せば出力デバイス無しでも回せる（render_session.py --app app）。
+    duration 秒（clock の秒）たったら終わる。None なら Ctrl+C まで"""
+    global musicgen, clock, preset_pool
+    clock = session_clock or RealClock()
+    musicgen = generator or connect()
+    clock.join()
+    segment_buffer = SegmentBuffer(emotions, get_current_emotion(), clock=clock)
+    note("emotion", emotion=segment_buffer.emotion)
+    clock.start_thread(background_generate, segment_buffer)
+
+    # プリセットループは起動時に1回だけデコード（2回目以降はメモリマップ）し、頭と尻尾のフェードも作っておく
+    preset_pool = PresetPool(PLAYBACK_RATE, 5000)
+    preset_pool.preload([path for paths in loop_files.values() for path in paths])
+
+    # 出力ストリームは1本だけ開きっぱなしにして、AI曲とプリセットBGMを crossfade で切り替える
+    if engine is None:
+        engine = AudioEngine(PLAYBACK_RATE)
+        engine.start()
+    ai_stream = None
+    bgm_emotion = None
+
+    try:
+        while duration is None or clock.now() < duration:
+            # 積まれたらすぐ起きる（0.1秒は再生状態を見直す間隔）
+            seg = segment_buffer.get(timeout=0.1)
+            if seg is not None:
+                if ai_stream is None:
+                    print(f"AI進化曲を再生（buffer残り={len(segment_buffer)}）")
+                    note("ai_play", emotion=segment_buffer.emotion)
+                    ai_stream = StreamSource(sleep=clock.sleep)
+                    engine.play(ai_stream)
+                    bgm_emotion = None
+                # リングバッファが満杯なら再生が進むまで待つ
+                ai_stream.write(seg)
+                continue
+            if ai_stream is not None and ai_stream.available() > engine.switch_fade:
+                # AI曲がまだ鳴っている
+                continue
+            emotion = get_current_emotion()
+            if bgm_emotion != emotion:
+                print("生成待ち→多曲ランダムクロスフェードBGM再生")
+                note("preset", emotion=emotion)
+                if ai_stream is not None:
+                    ai_stream.close()
+                    ai_stream = None
+                engine.play(preset_source(emotion))
+                bgm_emotion = emotion
+    except KeyboardInterrupt:
+        pass
+    finally:
+        segment_buffer.close()
+        clock.close()
+        engine.close()
+        print(f"終了（{engine.stats()}）")
+    return engine.stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,28 @@
 import os
-import threading
-import time
 import random
 import numpy as np
-import sounddevice as sd
-import soundfile as sf
-import torch
 import traceback
-from transformers import pipeline
+from audio_dsp import StageCrossfader, apply_fade, assemble, resample
+from preset_pool import PresetPool
+from segment_buffer import SegmentBuffer
+from session_clock import RealClock
+from audio_engine import PLAYBACK_RATE, ArraySource, AudioEngine, ShuffleSource, StreamSource
+from musicgen_server import PRIORITY_PLAYBACK, PRIORITY_PREFETCH, connect
 
 # ================ 基本設定 ================
 os.makedirs("output", exist_ok=True)
-device = 0 if torch.cuda.is_available() else -1
-pipe = pipeline("text-to-audio", model="facebook/musicgen-small", device=device)
+musicgen = None      # main() で connect()（推論サーバー python musicgen_server.py があればそれを使う）
+clock = RealClock()  # ヘッドレス再生（render_session.py）では仮想時計に差し替わる
+timeline = []        # 再生中に起きたこと（{"t": 秒, "event": ...}）
+MUSICGEN_BATCH_SIZE = 4  # intro〜outro を1バッチで生成（メモリ不足なら自動で小さくする）
+MUSICGEN_SEEDS = 4       # 1感情あたりの曲のバリエーション数（2周目からはキャッシュから読む）
+STREAM_STAGES = True      # パートが1つできるたびに再生キューへ送る（最初のAI曲までの待ちを1パート分に）
+STREAM_BATCH_SIZE = 1     # ストリーミング時のバッチサイズ
 
 emotions = ["uplift", "relax", "sad"]
 EMOTION_INTERVAL = 360  # 6分（360秒）
+PREFETCH_MARGIN = 1.3   # 次の感情の曲を「推定生成時間×これ」だけ前から作り始める
+DEFAULT_GEN_SEC = 120   # 生成時間の実績がまだ無いときの推定値（秒）
 
 preset_files = {
     "uplift": ["output/loop_uplift1.wav", "output/loop_uplift2.wav"],
@@ -44,180 +51,271 @@ emotion_parts = {
     ]
 }
 
-def fade(data, fade_len=3000):
-    if data.dtype != np.float32 and data.dtype != np.float64:
-        data = data.astype(np.float32)
-    fadein = np.linspace(0, 1, min(fade_len, len(data)))
-    fadeout = np.linspace(1, 0, min(fade_len, len(data)))
-    data[:len(fadein)] *= fadein
-    data[-len(fadeout):] *= fadeout
-    return data
-
-def crossfade(a, b, fade_len=3000):
-    a = a.astype(np.float32)
-    b = b.astype(np.float32)
-    fade_len = min(fade_len, len(a), len(b))
-    fade_out = np.linspace(1, 0, fade_len)
-    fade_in = np.linspace(0, 1, fade_len)
-    cross = a[-fade_len:] * fade_out + b[:fade_len] * fade_in
-    return np.concatenate([a[:-fade_len], cross, b[fade_len:]])
-
-def musicgen_generate_story(emotion, tokens=1024):
+CROSSFADE_SHAPE = "linear"  # "equal_power" にすると重なり中の音量が落ちない
+
+def note(event, **info):
+    """タイムラインにイベントを記録する（t は clock の秒）"""
+    timeline.append({"t": round(clock.now(), 3), "event": event, **info})
+
+def fade(data, rate, fade_len=3000):
+    """再生レートにそろえて頭と尻尾をフェード（float32 ならその場で）"""
+    return apply_fade(resample(data, rate, PLAYBACK_RATE), fade_len, CROSSFADE_SHAPE)
+
+def musicgen_generate_story(emotion, tokens=1024, priority=PRIORITY_PLAYBACK):
     parts = emotion_parts[emotion]
-    segs = []
-    sample_rate = None
+    seed = random.randrange(MUSICGEN_SEEDS)
     for name, prompt in parts:
-        try:
-            print(f"{emotion}: {name} 生成中: {prompt}")
-            audio = pipe(prompt, forward_params={"do_sample": True, "max_new_tokens": tokens})
-            if isinstance(audio, list):
-                audio = audio[0]
-            data = np.squeeze(audio["audio"])
-            data = fade(data)
-            segs.append(data)
-            sample_rate = audio["sampling_rate"]
-        except Exception as e:
-            print(f"=== {emotion}: {name} の生成で例外発生 ===")
-            print(traceback.format_exc())
-            segs.append(np.zeros(32000, dtype=np.float32))
-            sample_rate = 32000
-    song = segs[0]
-    for seg in segs[1:]:
-        song = crossfade(song, seg)
-    return song, sample_rate
-
-class SegmentBuffer:
+        print(f"{emotion}: {name} 生成中: {prompt}")
+    try:
+        results = musicgen.generate_batch([prompt for _, prompt in parts], tokens, MUSICGEN_BATCH_SIZE,
+                                          seed=seed, priority=priority)
+    except Exception as e:
+        print(f"=== {emotion}: まとめて生成で例外発生 → パートごとに生成し直します ===")
+        print(traceback.format_exc())
+        results = []
+        for name, prompt in parts:
+            try:
+                results += musicgen.generate_batch([prompt], tokens, 1, seed=seed, priority=priority)
+            except Exception as e:
+                print(f"=== {emotion}: {name} の生成で例外発生 ===")
+                print(traceback.format_exc())
+                results.append((np.zeros(PLAYBACK_RATE, dtype=np.float32), PLAYBACK_RATE))
+    segs = [fade(data, rate) for data, rate in results]
+    return assemble(segs, 3000, CROSSFADE_SHAPE), PLAYBACK_RATE
+
+def musicgen_stream_story(emotion, tokens=1024, priority=PRIORITY_PLAYBACK):
+    """パートごとに (フェード済みセグメント, rate) を生成でき次第 yield する（例外時は無音で埋める）"""
+    parts = emotion_parts[emotion]
+    seed = random.randrange(MUSICGEN_SEEDS)
+    prompts = [prompt for _, prompt in parts]
+    done = 0
+    try:
+        for data, rate in musicgen.iter_generate(prompts, tokens, STREAM_BATCH_SIZE, seed=seed,
+                                                 priority=priority):
+            print(f"{emotion}: {parts[done][0]} 生成完了")
+            yield fade(data, rate), PLAYBACK_RATE
+            done += 1
+    except Exception as e:
+        print(f"=== {emotion}: {parts[done][0]} の生成で例外発生 ===")
+        print(traceback.format_exc())
+        for _ in parts[done:]:
+            yield np.zeros(PLAYBACK_RATE, dtype=np.float32), PLAYBACK_RATE
+
+class StoryBuffer(SegmentBuffer):
+    """感情ごとのキュー。感情が切り替わっても先読みした曲は捨てずに次の出番まで残す"""
+
     def __init__(self):
-        self.buffer = []
-        self.lock = threading.Lock()
-        self.emotion = emotions[0]
-        self.running = True
-        self.rate = None
-
-    def append(self, seg, rate):
-        with self.lock:
-            self.buffer.append(seg)
-            self.rate = rate
-
-    def pop(self):
-        with self.lock:
-            if self.buffer:
-                return self.buffer.pop(0)
-            else:
-                return None
+        super().__init__(emotions, emotions[0], clock=clock)
+        self.track_done = {e: True for e in emotions}  # ストリーミング中の曲の最後のパートまで積み終わったか
+        self.next_emotion = emotions[1 % len(emotions)]
+        self.next_change_time = clock.now() + EMOTION_INTERVAL
+        self.playing_emotion = None  # AI曲を再生（リピート）中の感情
+
+    def ready(self, emotion):
+        """その感情の曲が積まれている（または積んでいる途中）か"""
+        with self.cond:
+            return bool(self.queues[emotion]) or not self.track_done[emotion]
+
+class GenerationTimer:
+    """直近の1曲あたりの生成時間（指数移動平均）"""
+
+    def __init__(self, default=DEFAULT_GEN_SEC, alpha=0.3):
+        self.value = None
+        self.default = default
+        self.alpha = alpha
+
+    def record(self, seconds):
+        self.value = seconds if self.value is None else self.alpha * seconds + (1 - self.alpha) * self.value
 
-    def clear(self):
-        with self.lock:
-            self.buffer = []
+    def estimate(self):
+        return self.default if self.value is None else self.value
 
-def background_generate(buffer: SegmentBuffer):
+def pick_target(buffer: StoryBuffer, timer: GenerationTimer):
+    """次に作る曲の感情を選ぶ（作る必要が無ければ None）"""
+    current, upcoming = buffer.emotion, buffer.next_emotion
+    time_left = buffer.next_change_time - clock.now()
+    need_current = buffer.playing_emotion != current and not buffer.ready(current)
+    need_upcoming = upcoming != current and not buffer.ready(upcoming)
+    if need_upcoming and time_left <= timer.estimate() * PREFETCH_MARGIN:
+        # 今から今の感情の曲を作っても切り替えまでに間に合わない → 次の感情を先に
+        print(f"⏩ 先読み開始: {upcoming}（推定 {timer.estimate():.0f} 秒 / 切り替えまで {time_left:.0f} 秒）")
+        return upcoming
+    if need_current:
+        return current
+    if need_upcoming:
+        return upcoming
+    return None
+
+def background_generate(buffer: StoryBuffer):
+    timer = GenerationTimer()
     while buffer.running:
-        emotion = buffer.emotion
+        emotion = pick_target(buffer, timer)
+        if emotion is None:
+            # キューが減る・感情が切り替わる（notify）と起きる
+            buffer.wait(timeout=1)
+            continue
+        priority = PRIORITY_PLAYBACK if emotion == buffer.emotion else PRIORITY_PREFETCH
+        t0 = clock.now()
+        note("generate", emotion=emotion)
         try:
             print(f"AI曲（物語型）を生成中...（emotion={emotion}）")
-            audio_data, rate = musicgen_generate_story(emotion, tokens=1024)
-            print(f"[DEBUG] 生成AI曲データ型: {type(audio_data)}, shape: {audio_data.shape}")
-            print(f"[DEBUG] サンプリングレート: {rate}")
-            buffer.append(audio_data, rate)
+            if STREAM_STAGES:
+                stream_story(buffer, emotion, priority)
+            else:
+                audio_data, rate = musicgen_generate_story(emotion, tokens=1024, priority=priority)
+                print(f"[DEBUG] 生成AI曲データ型: {type(audio_data)}, shape: {audio_data.shape}")
+                print(f"[DEBUG] サンプリングレート: {rate}")
+                buffer.put(audio_data, rate, emotion)
+            timer.record(clock.now() - t0)
+            note("generated", emotion=emotion, seconds=round(clock.now() - t0, 3))
         except Exception as e:
             print("=== AI曲生成で例外発生 ===")
             print(traceback.format_exc())
-        while buffer.running and buffer.emotion == emotion and buffer.buffer:
-            time.sleep(1)
-
-def play_preset_bgm_crossfade_random(emotion, rate, fade_len=3000, stop_event=None):
-    file_list = preset_files[emotion]
-    last_idx = -1
-    play_rate = rate or 32000
-    while True:
-        idx_candidates = [i for i in range(len(file_list)) if i != last_idx]
-        idx = random.choice(idx_candidates)
-        data, bgm_rate = sf.read(file_list[idx])
-        if data.dtype != np.float32 and data.dtype != np.float64:
-            data = data.astype(np.float32)
-        if play_rate is None:
-            play_rate = bgm_rate
-        if last_idx != -1:
-            last_data, _ = sf.read(file_list[last_idx])
-            if last_data.dtype != np.float32 and last_data.dtype != np.float64:
-                last_data = last_data.astype(np.float32)
-            seg_cf = crossfade(last_data, data, fade_len)
-        else:
-            seg_cf = fade(data, fade_len)
-            seg_cf = fade(seg_cf, fade_len)
-        sd.play(seg_cf, play_rate)
-        start = time.time()
-        duration = len(seg_cf) / play_rate
-        while time.time() - start < duration:
-            if stop_event and stop_event.is_set():
-                sd.stop()
-                return
-            time.sleep(0.1)
-        if stop_event and stop_event.is_set():
-            sd.stop()
-            return
-        last_idx = idx
+        finally:
+            buffer.track_done[emotion] = True
+            buffer.notify()
+
+def stream_story(buffer: StoryBuffer, emotion, priority=PRIORITY_PLAYBACK):
+    """パートができるたびに、次のパートとの crossfade 分を残してその感情のキューへ送る"""
+    buffer.track_done[emotion] = False
+    crossfader = StageCrossfader(3000, CROSSFADE_SHAPE)
+    rate = None
+    for seg, rate in musicgen_stream_story(emotion, tokens=1024, priority=priority):
+        buffer.put(crossfader.push(seg), rate, emotion)
+    if rate is not None:
+        buffer.put(crossfader.finish(), rate, emotion)
+
+def preset_source(emotion):
+    """その感情のプリセットループをランダム順に crossfade でつなぎ続ける音源（PCM はプールのものを使い回す）"""
+    return ShuffleSource(preset_pool.loops_for(preset_files[emotion]))
+
 
 def next_emotion_idx(idx):
     return (idx + 1) % len(emotions)
 
-segment_buffer = SegmentBuffer()
-bg_thread = threading.Thread(target=background_generate, args=(segment_buffer,), daemon=True)
-bg_thread.start()
-
-cur_emotion_idx = 0
-cur_emotion = emotions[cur_emotion_idx]
-next_change_time = time.time() + EMOTION_INTERVAL
-
-last_ai_track = None
-last_ai_rate = None
-
-try:
-    while True:
-        now = time.time()
-        if now >= next_change_time:
-            cur_emotion_idx = next_emotion_idx(cur_emotion_idx)
-            cur_emotion = emotions[cur_emotion_idx]
-            next_change_time = now + EMOTION_INTERVAL
-            segment_buffer.clear()
-            segment_buffer.emotion = cur_emotion
-            last_ai_track = None
-            print(f"\n感情切り替え: {cur_emotion}\n")
-
-        if last_ai_track is not None:
-            print(f"AI生成曲を再生（感情: {cur_emotion}）")
-            sd.play(last_ai_track, last_ai_rate)
-            sd.wait()
-            while time.time() < next_change_time:
-                print("AI曲をリピート再生中…")
-                sd.play(last_ai_track, last_ai_rate)
-                sd.wait()
-                if time.time() >= next_change_time:
-                    break
-            last_ai_track = None
-        else:
-            seg = segment_buffer.pop()
-            print(f"[DEBUG] popしたデータ: {type(seg)}, None? {seg is None}")
+def main(engine=None, session_clock=None, generator=None, duration=None):
+    """再生ループ。engine・session_clock・generator を渡せば出力デバイス無しでも回せる（render_session.py）。
+    duration 秒（clock の秒）たったら終わる。None なら Ctrl+C まで"""
+    global musicgen, clock, preset_pool
+    clock = session_clock or RealClock()
+    musicgen = generator or connect()
+    clock.join()
+    segment_buffer = StoryBuffer()
+    clock.start_thread(background_generate, segment_buffer)
+
+    cur_emotion_idx = 0
+    cur_emotion = emotions[cur_emotion_idx]
+    next_change_time = clock.now() + EMOTION_INTERVAL
+    segment_buffer.next_change_time = next_change_time
+    note("emotion", emotion=cur_emotion)
+
+    # プリセットループは起動時に1回だけデコード（2回目以降はメモリマップ）し、頭と尻尾のフェードも作っておく
+    preset_pool = PresetPool(PLAYBACK_RATE, 3000)
+    preset_pool.preload([path for paths in preset_files.values() for path in paths])
+
+    # 出力ストリームは1本だけ開きっぱなしにして、AI曲とプリセットBGMを crossfade で切り替える
+    if engine is None:
+        engine = AudioEngine(PLAYBACK_RATE)
+        engine.start()
+    ai_stream = None      # 再生中（生成中）のAI曲（次のパート待ちでプリセットに逃げている間は None）
+    ai_chunks = []        # リピート用にためておく、その曲のチャンク（曲が始まっていれば空でない）
+    last_ai_track = None  # 全パートがそろってリピート中のAI曲
+    bgm_emotion = None    # プリセットBGMを流している感情
+
+    try:
+        while duration is None or clock.now() < duration:
+            now = clock.now()
+            if now >= next_change_time:
+                cur_emotion_idx = next_emotion_idx(cur_emotion_idx)
+                cur_emotion = emotions[cur_emotion_idx]
+                next_change_time = now + EMOTION_INTERVAL
+                # 先読み済みの曲はそのまま残す（切り替え先のキューから再生）
+                segment_buffer.emotion = cur_emotion
+                segment_buffer.next_emotion = emotions[next_emotion_idx(cur_emotion_idx)]
+                segment_buffer.next_change_time = next_change_time
+                segment_buffer.playing_emotion = None
+                segment_buffer.notify()
+                if ai_stream is not None:
+                    ai_stream.close()
+                ai_stream = None
+                ai_chunks = []
+                last_ai_track = None
+                bgm_emotion = None
+                note("emotion", emotion=cur_emotion)
+                print(f"\n感情切り替え: {cur_emotion}\n")
+
+            if last_ai_track is not None:
+                # エンジンがリピートしている
+                clock.sleep(0.1)
+                continue
+
+            # get より先に見ておけば、True のときは最後のパートまでキューに積まれている
+            track_done = segment_buffer.track_done[cur_emotion]
+            # 積まれたらすぐ起きる（0.1秒は切り替え時刻などを見直す間隔）
+            seg = segment_buffer.get(timeout=0.1)
             if seg is not None:
-                last_ai_track = seg
-                last_ai_rate = segment_buffer.rate
+                # 届くのは出来上がったパート丸ごと（次との crossfade 分を除く）なので、ここで切り替えても途切れない
+                if ai_stream is None:
+                    if ai_chunks:
+                        print(f"AI生成曲に戻ります（感情: {cur_emotion}）")
+                        note("ai_resume", emotion=cur_emotion)
+                    else:
+                        print(f"AI生成曲を再生（感情: {cur_emotion}）")
+                        note("ai_play", emotion=cur_emotion)
+                        segment_buffer.playing_emotion = cur_emotion
+                        segment_buffer.notify()
+                    ai_stream = StreamSource(sleep=clock.sleep)
+                    engine.play(ai_stream)
+                    bgm_emotion = None
+                # リングバッファが満杯なら再生が進むまで待つ
+                ai_stream.write(seg)
+                ai_chunks.append(seg)
                 continue
-            print("生成待ち→プリセットBGMランダムクロスフェード再生")
-            stop_event = threading.Event()
-            th = threading.Thread(target=play_preset_bgm_crossfade_random,
-                                  args=(cur_emotion, segment_buffer.rate, 3000, stop_event))
-            th.start()
-            while last_ai_track is None and time.time() < next_change_time:
-                seg = segment_buffer.pop()
-                print(f"[DEBUG] popしたデータ（待機ループ）: {type(seg)}, None? {seg is None}")
-                if seg is not None:
-                    last_ai_track = seg
-                    last_ai_rate = segment_buffer.rate
-                    break
-                time.sleep(0.5)
-            stop_event.set()
-            th.join()
-except KeyboardInterrupt:
-    segment_buffer.running = False
-    sd.stop()
-    print("終了")
+
+            if ai_stream is not None:
+                if STREAM_STAGES and not track_done:
+                    if ai_stream.available() > engine.switch_fade:
+                        # 次のパートの生成待ち（まだ鳴らすものが残っている）
+                        continue
+                    # 次のパートが間に合わない → 残りを crossfade で流しきりながらプリセットBGMへ（届いたら戻る）
+                    print("次のパートの生成待ち→プリセットBGMへ")
+                    note("preset", emotion=cur_emotion)
+                    ai_stream.close()
+                    ai_stream = None
+                    engine.play(preset_source(cur_emotion))
+                    bgm_emotion = cur_emotion
+                    continue
+                # 全パートそろった → 流し終わったら切れ目なくリピート
+                print("AI曲をリピート再生中…")
+                note("ai_repeat", emotion=cur_emotion)
+                ai_stream.close()
+                ai_stream = None
+                last_ai_track = np.concatenate(ai_chunks)
+                engine.enqueue(ArraySource(last_ai_track, loop=True))
+                continue
+
+            if ai_chunks and track_done:
+                # プリセットBGMに逃げている間に曲が終わった（残りのパートが来なかった）→ そこまでをリピート
+                print("AI曲をリピート再生中…")
+                note("ai_repeat", emotion=cur_emotion)
+                last_ai_track = np.concatenate(ai_chunks)
+                engine.play(ArraySource(last_ai_track, loop=True))
+                continue
+
+            if bgm_emotion != cur_emotion:
+                print("生成待ち→プリセットBGMランダムクロスフェード再生")
+                note("preset", emotion=cur_emotion)
+                engine.play(preset_source(cur_emotion))
+                bgm_emotion = cur_emotion
+    except KeyboardInterrupt:
+        pass
+    finally:
+        segment_buffer.close()
+        clock.close()
+        engine.close()
+        print(f"終了（{engine.stats()}）")
+    return engine.stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import numpy as np
+
+# ==== フェードカーブ ====
+# (長さ, 形) ごとに1回だけ作って使い回す（float32・読み取り専用）
+FADE_SHAPES = ("linear", "equal_power")
+_curves = {}
+
+
+def fade_curves(length, shape="linear"):
+    """(フェードイン, フェードアウト) のカーブを返す。
+    linear は振幅が直線、equal_power は sin/cos で重なり中の音量（パワー）が一定になる"""
+    key = (length, shape)
+    curves = _curves.get(key)
+    if curves is None:
+        t = np.linspace(0, 1, length, dtype=np.float32)
+        if shape == "linear":
+            fade_in, fade_out = t, t[::-1].copy()
+        elif shape == "equal_power":
+            fade_in = np.sin(t * np.float32(np.pi / 2))
+            fade_out = np.cos(t * np.float32(np.pi / 2))
+        else:
+            raise ValueError(f"未対応のフェード形状: {shape}")
+        fade_in.flags.writeable = False
+        fade_out.flags.writeable = False
+        curves = _curves[key] = (fade_in, fade_out)
+    return curves
+
+
+# ==== 音量（float32 のその場書き換え） ====
+def as_float32(data):
+    """float32 ならそのまま、それ以外は float32 にしたコピーを返す"""
+    return np.asarray(data, dtype=np.float32)
+
+
+def apply_fade(data, fade_len=3000, shape="linear", head=True, tail=True):
+    """頭（head）と尻尾（tail）にフェードを掛けて返す。
+    float32 なら data そのものを書き換える（それ以外は float32 のコピーに掛ける）"""
+    data = as_float32(data)
+    n = min(fade_len, len(data))
+    if n:
+        fade_in, fade_out = fade_curves(n, shape)
+        if head:
+            data[:n] *= fade_in
+        if tail:
+            data[len(data) - n:] *= fade_out
+    return data
+
+
+def peak(data):
+    """絶対値の最大（abs の一時配列を作らない）"""
+    return max(float(data.max()), -float(data.min())) if len(data) else 0.0
+
+
+def loudness_db(data):
+    """RMS の dBFS（無音は -inf）。K 特性などの聴感補正はしない簡易版"""
+    if not len(data):
+        return float("-inf")
+    rms = np.sqrt(np.dot(data, data) / len(data))
+    return float(20 * np.log10(rms)) if rms > 0 else float("-inf")
+
+
+def normalize_peak(data, target=0.98):
+    """ピークが target になるようその場で音量を揃えて返す（無音はそのまま）"""
+    data = as_float32(data)
+    p = peak(data)
+    if p > 0:
+        data *= np.float32(target / p)
+    return data
+
+
+def normalize_loudness(data, target_db=-18.0, max_peak=0.98):
+    """RMS が target_db になるようその場で音量を揃えて返す。ピークが max_peak を超えるほどは上げない"""
+    data = as_float32(data)
+    level, p = loudness_db(data), peak(data)
+    if p > 0 and np.isfinite(level):
+        gain = min(10 ** ((target_db - level) / 20), max_peak / p)
+        data *= np.float32(gain)
+    return data
+
+
+# ==== サンプリングレート変換 ====
+# ポリフェーズ方式: up 倍に補間 → ローパス → down 分の1に間引く、を必要な出力サンプルだけ計算する。
+# フィルタは窓付き sinc（Kaiser 窓）を位相ごとに分けたもので、(up, down) ごとに1回だけ作って使い回す
+RESAMPLE_ZEROS = 10     # フィルタの片側に入れる sinc のゼロ交差数（多いほど急峻・遅い）
+RESAMPLE_BETA = 5.0     # Kaiser 窓の β
+RESAMPLER = f"poly{RESAMPLE_ZEROS}k{RESAMPLE_BETA:g}"  # 方式の名前（変換結果をキャッシュする側が使う）
+_filter_banks = {}
+
+
+def _filter_bank(up, down):
+    """位相ごとのフィルタ係数 bank[位相, タップ]（畳み込み順を逆にして内積で使える向き）と、片側の長さを返す"""
+    key = (up, down)
+    cached = _filter_banks.get(key)
+    if cached is None:
+        half = RESAMPLE_ZEROS * max(up, down)
+        cutoff = 1.0 / max(up, down)
+        t = np.arange(-half, half + 1)
+        h = np.sinc(cutoff * t) * np.kaiser(2 * half + 1, RESAMPLE_BETA)
+        h *= up / h.sum()
+        taps = -(-len(h) // up)
+        h = np.concatenate([h, np.zeros(taps * up - len(h))])
+        bank = h.reshape(taps, up).T[:, ::-1].astype(np.float32)
+        cached = _filter_banks[key] = (np.ascontiguousarray(bank), half)
+    return cached
+
+
+def resample(data, rate_in, rate_out):
+    """ポリフェーズ FIR でサンプリングレートを変える（float32 で返す。同じレートならそのまま）"""
+    data = as_float32(data)
+    if rate_in == rate_out or not len(data):
+        return data
+    g = np.gcd(int(rate_in), int(rate_out))
+    up, down = int(rate_out) // g, int(rate_in) // g
+    bank, half = _filter_bank(up, down)
+    taps = bank.shape[1]
+    n_out = -(-len(data) * up // down)
+    padded = np.zeros(len(data) + 2 * taps, dtype=np.float32)
+    padded[taps:taps + len(data)] = data
+    windows = np.lib.stride_tricks.sliding_window_view(padded, taps)
+    out = np.empty(n_out, dtype=np.float32)
+    # 出力 n は「補間後の n*down+half 番目」。位相 (n*down+half) % up が同じ出力は up 個おきに並び、
+    # そのとき使う入力の窓は down サンプルずつずれるので、位相ごとに行列×ベクトル1回で計算できる
+    for r in range(min(up, n_out)):
+        m = r * down + half
+        start = m // up + 1
+        count = (n_out - r + up - 1) // up
+        out[r::up] = windows[start:start + (count - 1) * down + 1:down] @ bank[m % up]
+    return out
+
+
+# ==== まとめてつなぐ ====
+def assemble(segments, fade_len=3000, shape="linear"):
+    """segments を順に crossfade でつないだ1本の float32 配列を返す。
+    先に全長を計算して1回だけ確保し、各セグメントはその中へ直接書く（全長に比例する時間・追加メモリはフェード分だけ）"""
+    segments = [as_float32(seg) for seg in segments]
+    end = 0
+    starts = []
+    for seg in segments:
+        n = min(fade_len, end, len(seg))
+        starts.append((end - n, n))
+        end = end - n + len(seg)
+    out = np.empty(end, dtype=np.float32)
+    for seg, (start, n) in zip(segments, starts):
+        if n:
+            fade_in, fade_out = fade_curves(n, shape)
+            cross = out[start:start + n]
+            cross *= fade_out
+            cross += seg[:n] * fade_in
+        out[start + n:start + len(seg)] = seg[n:]
+    return out
+
+
+def crossfade(a, b, fade_len=3000, shape="linear"):
+    """a の尻尾と b の頭を fade_len サンプル重ねてつなぐ（shape="equal_power" なら重なり中の音量が落ちない）"""
+    return assemble([a, b], fade_len, shape)
+
+
+# ==== ステージを順につなぐ crossfade（ストリーミング用） ====
+class StageCrossfader:
+    """順に届くセグメントを crossfade でつなぎ、確定した部分だけを返す。
+    末尾の fade_len サンプルは次のセグメントと重ねるまで手元に残し、finish() で吐き出す。
+    全部まとめて assemble したときと同じ波形になる"""
+
+    def __init__(self, fade_len=3000, shape="linear"):
+        self.fade_len = fade_len
+        self.shape = shape
+        self.tail = np.zeros(0, dtype=np.float32)
+
+    def push(self, seg):
+        seg = as_float32(seg)
+        n = min(self.fade_len, len(self.tail), len(seg))
+        out = np.empty(len(self.tail) + len(seg) - n, dtype=np.float32)
+        head = len(self.tail) - n
+        out[:head] = self.tail[:head]
+        if n:
+            fade_in, fade_out = fade_curves(n, self.shape)
+            np.multiply(self.tail[head:], fade_out, out=out[head:head + n])
+            out[head:head + n] += seg[:n] * fade_in
+        out[head + n:] = seg[n:]
+        keep = min(self.fade_len, len(out))
+        self.tail = out[len(out) - keep:].copy()
+        return out[:len(out) - keep]
+
+    def finish(self):
+        rest, self.tail = self.tail, np.zeros(0, dtype=np.float32)
+        return rest
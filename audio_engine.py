@@ -0,0 +1,308 @@
+import collections
+import queue
+import random
+import threading
+import time
+import numpy as np
+from audio_dsp import fade_curves
+
+# ==== 設定 ====
+PLAYBACK_RATE = 32000   # MusicGen の出力と同じ
+BLOCK_SIZE = 1024       # コールバック1回ぶんのサンプル数（切り替えの遅れはこれ1つ分）
+SWITCH_FADE = 16000     # 音源を切り替えるときの crossfade（サンプル数）
+RING_SECONDS = 30       # ストリーム音源のリングバッファの長さ
+
+
+# ==== リングバッファ ====
+class RingBuffer:
+    """書き手1つ・読み手1つ（SPSC）用の float32 リングバッファ。
+    書き手は write_pos だけ、読み手は read_pos だけを進めるのでロック不要"""
+
+    def __init__(self, capacity):
+        self.buf = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.read_pos = 0
+        self.write_pos = 0
+
+    def available(self):
+        return self.write_pos - self.read_pos
+
+    def space(self):
+        return self.capacity - self.available()
+
+    def write(self, data):
+        """書けた分のサンプル数を返す（満杯なら途中まで）"""
+        n = min(len(data), self.space())
+        start = self.write_pos % self.capacity
+        first = min(n, self.capacity - start)
+        self.buf[start:start + first] = data[:first]
+        self.buf[:n - first] = data[first:n]
+        self.write_pos += n
+        return n
+
+    def read_into(self, out):
+        """out の先頭から読めた分だけ書き、そのサンプル数を返す"""
+        n = min(len(out), self.available())
+        start = self.read_pos % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.buf[start:start + first]
+        out[first:n] = self.buf[:n - first]
+        self.read_pos += n
+        return n
+
+
+# ==== 音源 ====
+# どれも read_into(out) で out の先頭に書けた分のサンプル数を返す。
+# finished が True になったらもう音は出ない（エンジンは次の音源へ進む）
+class ArraySource:
+    """メモリ上の音声をそのまま流す（loop=True なら繰り返す）"""
+
+    def __init__(self, data, loop=False):
+        self.data = np.asarray(data, dtype=np.float32)
+        self.loop = loop
+        self.pos = 0
+
+    @property
+    def finished(self):
+        return not self.loop and self.pos >= len(self.data)
+
+    def read_into(self, out):
+        written = 0
+        while written < len(out) and len(self.data):
+            if self.pos >= len(self.data):
+                if not self.loop:
+                    break
+                self.pos = 0
+            n = min(len(out) - written, len(self.data) - self.pos)
+            out[written:written + n] = self.data[self.pos:self.pos + n]
+            self.pos += n
+            written += n
+        return written
+
+
+class StreamSource:
+    """生成しながら届く音声を流す。書き手は write()、書き終えたら close()。
+    sleep はリングが空くのを待つ関数（ヘッドレス再生では仮想時計の sleep を渡す）"""
+
+    def __init__(self, seconds=RING_SECONDS, rate=PLAYBACK_RATE, sleep=time.sleep):
+        self.ring = RingBuffer(int(seconds * rate))
+        self.rate = rate
+        self.sleep = sleep
+        self.closed = False
+
+    @property
+    def finished(self):
+        return self.closed and self.ring.available() == 0
+
+    def available(self):
+        return self.ring.available()
+
+    def write(self, data, timeout=None):
+        """全部書けるまで待つ（リングが満杯なら再生が進むのを待つ＝背圧）。書けたサンプル数を返す"""
+        data = np.asarray(data, dtype=np.float32)
+        deadline = None if timeout is None else time.time() + timeout
+        written = 0
+        while written < len(data):
+            written += self.ring.write(data[written:])
+            if written < len(data):
+                if deadline is not None and time.time() >= deadline:
+                    break
+                self.sleep(BLOCK_SIZE / self.rate)
+        return written
+
+    def close(self):
+        self.closed = True
+
+    def read_into(self, out):
+        return self.ring.read_into(out)
+
+
+class PresetLoop:
+    """ループ1本の PCM と、crossfade 用に先にフェードをかけておいた頭と尻尾（つなぎ目で掛け算しなくて済む）"""
+
+    def __init__(self, data, fade_len=3000):
+        self.data = np.asarray(data, dtype=np.float32)
+        n = min(fade_len, len(self.data) // 2)
+        fade_in, fade_out = fade_curves(n)
+        self.fade_len = n
+        self.head = self.data[:n] * fade_in
+        self.tail = self.data[len(self.data) - n:] * fade_out
+
+
+class ShuffleSource:
+    """複数のループをランダム順（同じものは続けない）に、つなぎ目を crossfade しながら流し続ける。
+    tracks は PresetLoop（プリセットプールの使い回し）か配列"""
+
+    def __init__(self, tracks, fade_len=3000):
+        self.loops = [t if isinstance(t, PresetLoop) else PresetLoop(t, fade_len) for t in tracks]
+        self.loops = [loop for loop in self.loops if loop.fade_len]
+        self.finished = not self.loops
+        self.cur = random.randrange(len(self.loops)) if self.loops else 0
+        self.nxt = None
+        self.pos = 0
+
+    def _pick_next(self):
+        candidates = [i for i in range(len(self.loops)) if i != self.cur] or [self.cur]
+        return random.choice(candidates)
+
+    def read_into(self, out):
+        written = 0
+        while written < len(out) and not self.finished:
+            cur = self.loops[self.cur]
+            if self.nxt is None:
+                self.nxt = self._pick_next()
+            nxt = self.loops[self.nxt]
+            n_fade = min(cur.fade_len, nxt.fade_len)
+            xfade_start = len(cur.data) - n_fade
+            if self.pos < xfade_start:
+                n = min(xfade_start - self.pos, len(out) - written)
+                out[written:written + n] = cur.data[self.pos:self.pos + n]
+            else:
+                # 今のループの末尾と次のループの先頭を重ねる
+                k = self.pos - xfade_start
+                n = min(n_fade - k, len(out) - written)
+                dst = out[written:written + n]
+                if cur.fade_len == nxt.fade_len:
+                    np.add(cur.tail[k:k + n], nxt.head[k:k + n], out=dst)
+                else:
+                    # 長さの違う短いループ同士だけはその場でフェードを掛ける
+                    fade_in, fade_out = fade_curves(n_fade)
+                    np.multiply(cur.data[self.pos:self.pos + n], fade_out[k:k + n], out=dst)
+                    dst += nxt.data[k:k + n] * fade_in[k:k + n]
+            self.pos += n
+            written += n
+            if self.pos >= len(cur.data):
+                self.cur, self.pos, self.nxt = self.nxt, n_fade, None
+        return written
+
+
+# ==== 出力エンジン ====
+class AudioEngine:
+    """1本の OutputStream を開きっぱなしにして、コールバックで音源をブロック単位で混ぜる。
+    play() は次のブロックから crossfade で切り替え、enqueue() は今の音源が終わった直後に隙間なくつなぐ。
+    play()/enqueue() は命令をキューに積むだけで、音源の入れ替えはすべてコールバック側で行う"""
+
+    def __init__(self, rate=PLAYBACK_RATE, block_size=BLOCK_SIZE, switch_fade=SWITCH_FADE):
+        self.rate = rate
+        self.block_size = block_size
+        self.switch_fade = switch_fade
+        self.current = None
+        self.queue = collections.deque()     # current の次に流す音源（コールバックだけが触る）
+        self.commands = queue.SimpleQueue()  # play()/enqueue() からコールバックへの命令
+        self.fading = []            # crossfade で消えていく音源 [音源, フェードの位置, フェードの長さ]
+        self.fade_pos = 0           # current のフェードインの進み具合（fade_len に達したら完了）
+        self.fade_len = 0
+        self.scratch = np.zeros(block_size, dtype=np.float32)
+        self.stream = None
+        self.lock = threading.Lock()
+        # 統計
+        self.blocks = 0
+        self.underruns = 0          # 再生中のストリーム音源が空で無音を埋めたブロック数
+        self.device_underflows = 0  # デバイス側の出力アンダーフロー
+
+    def start(self):
+        import sounddevice as sd
+        with self.lock:
+            if self.stream is not None:
+                return
+            self.stream = sd.OutputStream(samplerate=self.rate, blocksize=self.block_size, channels=1,
+                                          dtype="float32", callback=self._callback)
+            self.stream.start()
+
+    def close(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.stop()
+                self.stream.close()
+                self.stream = None
+
+    # ---- 操作（メインスレッドから） ----
+    def play(self, source, fade=None):
+        """source へ crossfade で切り替える（None なら無音へフェードアウト）。キューは捨てる"""
+        self.commands.put(("play", source, self.switch_fade if fade is None else fade))
+
+    def enqueue(self, source):
+        self.commands.put(("enqueue", source))
+
+    def stop(self, fade=None):
+        self.play(None, fade)
+
+    def idle(self):
+        """鳴らすものが何も無いか"""
+        return self.commands.empty() and not self.queue and (self.current is None or self.current.finished)
+
+    def stats(self):
+        return {"blocks": self.blocks, "underruns": self.underruns, "device_underflows": self.device_underflows}
+
+    # ---- コールバック（オーディオスレッド） ----
+    def _switch(self, source, fade):
+        self.queue.clear()
+        if fade <= 0:
+            self.fading = []
+        elif self.current is not None:
+            # フェードイン途中の音源は、今の音量からフェードアウトを始める（フェードのカーブは前後対称）
+            pos = self.fade_len - 1 - self.fade_pos if self.fade_pos < self.fade_len else 0
+            length = self.fade_len if self.fade_pos < self.fade_len else fade
+            self.fading.append([self.current, pos, length])
+        self.current = source
+        self.fade_pos, self.fade_len = 0, fade
+
+    def _read(self, out):
+        """今の音源（終わったらキューの次）で out を埋め、書けたサンプル数を返す"""
+        written = 0
+        while written < len(out):
+            source = self.current
+            if source is None or source.finished:
+                if not self.queue:
+                    break
+                self.current = self.queue.popleft()
+                continue
+            got = source.read_into(out[written:])
+            written += got
+            if got == 0:
+                # ストリーム音源の生成が再生に追いついていない
+                self.underruns += 1
+                break
+        return written
+
+    def _callback(self, outdata, frames, time_info, status):
+        if status.output_underflow:
+            self.device_underflows += 1
+        self.render(outdata[:, 0])
+
+    def render(self, out):
+        """次のブロックを混ぜて out に書く（出力デバイスを使わないヘッドレス再生ではこれを直接呼ぶ）"""
+        frames = len(out)
+        self.blocks += 1
+        while True:
+            try:
+                command = self.commands.get_nowait()
+            except queue.Empty:
+                break
+            if command[0] == "play":
+                self._switch(command[1], command[2])
+            else:
+                self.queue.append(command[1])
+        n = self._read(out)
+        out[n:] = 0
+        if self.fade_pos < self.fade_len:
+            # 新しい音源はフェードイン
+            fade_in, _ = fade_curves(self.fade_len)
+            k = self.fade_pos
+            m = min(frames, self.fade_len - k)
+            out[:m] *= fade_in[k:k + m]
+            self.fade_pos += m
+        # 切り替え前の音源は、それぞれのフェードの続きからフェードアウトして重ねる（途中で次の切り替えが来ても途切れない）
+        for fading in self.fading:
+            source, k, length = fading
+            _, fade_out = fade_curves(length)
+            m = min(frames, length - k)
+            if len(self.scratch) < m:
+                self.scratch = np.zeros(m, dtype=np.float32)
+            old = self.scratch[:m]
+            got = source.read_into(old)
+            old[got:] = 0
+            old *= fade_out[k:k + m]
+            out[:m] += old
+            fading[1] += m
+        self.fading = [fading for fading in self.fading if fading[1] < fading[2]]
@@ -0,0 +1,99 @@
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import audio_dsp
+
+RATE = 32000
+
+
+# ==== 比べる相手（共通化する前の書き方） ====
+def old_fade(data, fade_len=3000):
+    """毎回 float64 の linspace を作っていた頃のフェード"""
+    if data.dtype != np.float32 and data.dtype != np.float64:
+        data = data.astype(np.float32)
+    fadein = np.linspace(0, 1, min(fade_len, len(data)))
+    fadeout = np.linspace(1, 0, min(fade_len, len(data)))
+    data[:len(fadein)] *= fadein
+    data[-len(fadeout):] *= fadeout
+    return data
+
+
+def old_crossfade(a, b, fade_len=3000):
+    fade_out = np.linspace(1, 0, fade_len)
+    fade_in = np.linspace(0, 1, fade_len)
+    return np.concatenate([a[:-fade_len], a[-fade_len:] * fade_out + b[:fade_len] * fade_in, b[fade_len:]])
+
+
+def linear_resample(data, rate_in, rate_out):
+    """前の線形補間版（速いが折り返しノイズが残る）"""
+    n_out = int(round(len(data) * rate_out / rate_in))
+    positions = np.arange(n_out, dtype=np.float64) * (rate_in / rate_out)
+    return np.interp(positions, np.arange(len(data)), data).astype(np.float32)
+
+
+# ==== 計測 ====
+def measure(func, runs):
+    """(1回あたりの中央値ミリ秒, 1回あたりのピーク追加メモリMB) を返す"""
+    func()  # ウォームアップ（カーブ・フィルタのキャッシュもここで作る）
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return float(np.median(times)) * 1000, peak / 1024**2
+
+
+def alias_db(resampler, rate_in, rate_out):
+    """変換先のナイキストより上の音（rate_out/2 の 1.25 倍）がどれだけ残るか（dB。小さいほど良い）"""
+    t = np.arange(rate_in * 2) / rate_in
+    tone = np.sin(2 * np.pi * rate_out / 2 * 1.25 * t).astype(np.float32)
+    y = resampler(tone, rate_in, rate_out)[rate_out // 10:-rate_out // 10]
+    return audio_dsp.loudness_db(y) - audio_dsp.loudness_db(tone)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="audio_dsp のフェード・crossfade・正規化・リサンプルの速さを比べる")
+    parser.add_argument("--seconds", type=float, default=20, help="1セグメントの長さ（秒。MusicGen 1024トークン≒20秒）")
+    parser.add_argument("--segments", type=int, default=20, help="つなぐセグメント数")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    segs = [rng.normal(0, 0.1, int(args.seconds * RATE)).astype(np.float32) for _ in range(args.segments)]
+    seg = segs[0]
+    wav = rng.normal(0, 0.1, int(args.seconds * 44100)).astype(np.float32)
+
+    def chained():
+        out = segs[0]
+        for s in segs[1:]:
+            out = old_crossfade(out, s)
+        return out
+
+    cases = [
+        ("fade（旧: float64 linspace）", lambda: old_fade(seg.copy())),
+        ("fade（apply_fade）", lambda: audio_dsp.apply_fade(seg.copy())),
+        (f"crossfade {args.segments}本（旧: 順に concatenate）", chained),
+        (f"crossfade {args.segments}本（assemble）", lambda: audio_dsp.assemble(segs)),
+        ("equal_power crossfade（assemble）", lambda: audio_dsp.assemble(segs, shape="equal_power")),
+        ("normalize_peak", lambda: audio_dsp.normalize_peak(seg.copy())),
+        ("normalize_loudness", lambda: audio_dsp.normalize_loudness(seg.copy())),
+        ("44.1k→32k（旧: 線形補間）", lambda: linear_resample(wav, 44100, RATE)),
+        ("44.1k→32k（ポリフェーズ）", lambda: audio_dsp.resample(wav, 44100, RATE)),
+        ("48k→32k（ポリフェーズ）", lambda: audio_dsp.resample(wav, 48000, RATE)),
+    ]
+    print(f"🎛️ {args.seconds:.0f} 秒 × {args.segments} セグメント（{RATE} Hz）")
+    for name, func in cases:
+        ms, mb = measure(func, args.runs)
+        print(f"  {name:<36} {ms:8.2f} ms  ピーク +{mb:6.1f} MB")
+    print("折り返しノイズ（44.1k→32k、20kHz の音）:"
+          f" 線形 {alias_db(linear_resample, 44100, RATE):.1f} dB /"
+          f" ポリフェーズ {alias_db(audio_dsp.resample, 44100, RATE):.1f} dB")
+
+
+if __name__ == "__main__":
+    main()
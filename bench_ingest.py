@@ -0,0 +1,166 @@
+import argparse
+import asyncio
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import step1_get_heart_rate as ingest
+from hr_log import PartitionedLog
+from hrm_packets import FLAG_RR, read_capture
+
+
+# ==== 疑似パケット ====
+def synthetic_packets(count, start=None, hr=70.0, seed=0):
+    """COOSPO と同じ形式（8bit心拍＋RR）の通知を count 個、1秒おきに作る"""
+    rng = np.random.default_rng(seed)
+    start = time.time() if start is None else start
+    packets = []
+    for i in range(count):
+        bpm = int(np.clip(hr + 8 * np.sin(i / 300) + rng.normal(0, 2), 40, 200))
+        rr = [int(np.clip(rng.normal(60_000 / bpm, 40), 300, 2000) * 1024 / 1000)
+              for _ in range(rng.integers(1, 3))]
+        payload = bytes([FLAG_RR, bpm]) + b"".join(v.to_bytes(2, "little") for v in rr)
+        packets.append((start + i, payload))
+    return packets
+
+
+def recorded_packets(directory):
+    """hrm_packets の生パケット保存（logs/<名前>/capture）から読み込む"""
+    records = read_capture(directory)
+    return [(float(r["timestamp"]), bytes(r["payload"][:r["length"]])) for r in records]
+
+
+# ==== BleakClient の代わり ====
+class ReplayClient:
+    """BleakClient と同じ start_notify/stop_notify で、記録済み・疑似パケットを rate 倍速で流す。
+    rate=0 なら待たずに流せるだけ流す"""
+
+    def __init__(self, packets, rate=1.0, disconnected_callback=None):
+        self.packets = packets
+        self.rate = rate
+        self.disconnected_callback = disconnected_callback
+        self.task = None
+        self.lags = []   # 予定時刻からの遅れ（秒）
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop_notify(None)
+
+    async def start_notify(self, uuid, callback):
+        self.task = asyncio.create_task(self._replay(callback))
+
+    async def stop_notify(self, uuid):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    async def wait_done(self):
+        await self.task
+
+    async def _replay(self, callback):
+        if not self.packets:
+            return
+        t0 = time.perf_counter()
+        ts0 = self.packets[0][0]
+        for i, (ts, payload) in enumerate(self.packets):
+            if self.rate > 0:
+                due = t0 + (ts - ts0) / self.rate
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self.lags.append(max(time.perf_counter() - due, 0.0))
+            elif i % 256 == 0:
+                # 書き込みタスクにも順番を回す
+                await asyncio.sleep(0)
+            callback(None, bytearray(payload))
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+
+# ==== ベンチマーク ====
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(values):
+    if not len(values):
+        return "n/a"
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1e6
+    return f"p50 {p50:.1f} µs / p95 {p95:.1f} µs / p99 {p99:.1f} µs / max {np.max(values) * 1e6:.1f} µs"
+
+
+async def run_bench(packets, rate, log_dir, trace_memory):
+    ingest.LOG_DIR = log_dir
+    session = ingest.DeviceSession("bench", "replay")
+    latencies = np.zeros(len(packets))
+    handle = session.handle_heart_rate
+    count = 0
+
+    def timed(sender, data):
+        nonlocal count
+        t = time.perf_counter()
+        handle(sender, data)
+        latencies[count] = time.perf_counter() - t
+        count += 1
+
+    session.log_writer.start()
+    if session.capture_writer is not None:
+        session.capture_writer.start()
+    if trace_memory:
+        tracemalloc.start()
+    mem_start = rss_mb()
+    t0 = time.perf_counter()
+    async with ReplayClient(packets, rate) as client:
+        await client.start_notify(ingest.HR_UUID, timed)
+        await client.wait_done()
+    replay_sec = time.perf_counter() - t0
+    await session.log_writer.close()
+    if session.capture_writer is not None:
+        await session.capture_writer.close()
+    total_sec = time.perf_counter() - t0
+    traced = tracemalloc.get_traced_memory() if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    written = len(PartitionedLog(ingest.log_dir_for("bench")).read_range())
+    print(f"📦 パケット {count} 個 / 倍速 {rate or '最大'} / 送出 {replay_sec:.2f} 秒（書き出し完了まで {total_sec:.2f} 秒）")
+    print(f"⏱️ ハンドラ処理時間: {percentiles(latencies[:count])}")
+    if client.lags:
+        print(f"🕒 予定時刻からの遅れ: {percentiles(np.asarray(client.lags))}")
+    print(f"💾 書き込み行数 {written}（{written / total_sec:.0f} 行/s）")
+    print(f"🧠 RSS {mem_start:.1f} MB → {rss_mb():.1f} MB")
+    if traced:
+        print(f"🧠 tracemalloc 現在 {traced[0] / 2**20:.2f} MB / ピーク {traced[1] / 2**20:.2f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="心拍取り込み処理のリプレイ負荷試験（実機不要）")
+    parser.add_argument("--packets", type=int, default=100_000, help="疑似パケット数")
+    parser.add_argument("--capture", help="記録済み生パケットのログDir（指定時は疑似パケットの代わりに使う）")
+    parser.add_argument("--rate", type=float, nargs="+", default=[100, 10_000, 0],
+                        help="再生倍速（1=実時間、0=待たずに最大速度）")
+    parser.add_argument("--trace-memory", action="store_true", help="tracemalloc でメモリ増加を測る（遅くなる）")
+    parser.add_argument("--verbose", action="store_true", help="パケットごとの表示を残す")
+    args = parser.parse_args()
+
+    ingest.VERBOSE = args.verbose
+    packets = recorded_packets(args.capture) if args.capture else synthetic_packets(args.packets)
+    for rate in args.rate:
+        log_dir = tempfile.mkdtemp(prefix="bench_ingest_")
+        try:
+            asyncio.run(run_bench(packets, rate, log_dir, args.trace_memory))
+        finally:
+            shutil.rmtree(log_dir, ignore_errors=True)
+        print()
+
+
+if __name__ == "__main__":
+    main()
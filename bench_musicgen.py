@@ -0,0 +1,73 @@
+import argparse
+import copy
+import os
+import time
+import numpy as np
+import soundfile as sf
+from musicgen_util import MUSICGEN_MODEL, generate_batch, load_pipeline, optimize_for_cpu
+
+# ==== 比べる設定 ====
+CONFIGS = {
+    "fp32": {"quantize": False, "matmul_precision": "highest"},       # 今のまま
+    "bf16": {"quantize": False, "matmul_precision": "medium"},        # 行列積だけ bf16
+    "int8": {"quantize": True, "matmul_precision": "highest"},        # デコーダーを int8 に動的量子化
+    "int8-bf16": {"quantize": True, "matmul_precision": "medium"},
+}
+BENCH_PROMPT = "lofi intro, chill R&B guitar, vinyl noise, slow 60 BPM, peaceful, gentle, elegant"
+BENCH_OUT_DIR = "output/bench"
+
+
+def run_config(base, name, threads, tokens, runs, prompt):
+    """1設定ぶん計測して (秒, 音声秒数, 音声) を返す。モデルは設定ごとに複製してから最適化する"""
+    pipe = copy.copy(base)
+    pipe.model = copy.deepcopy(base.model)
+    optimize_for_cpu(pipe, threads=threads, **CONFIGS[name])
+    generate_batch(pipe, [prompt], 16, 1, seed=0)  # ウォームアップ
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        audio, rate = generate_batch(pipe, [prompt], tokens, 1, seed=0)[0]
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times)), len(audio) / rate, audio, rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MusicGen の CPU 推論設定ごとの速度（tokens/s・実時間比）を比べる")
+    parser.add_argument("--model", default=MUSICGEN_MODEL)
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument("--threads", type=int, nargs="+", default=[0],
+                        help="試すスレッド数（0 = torch の既定値）")
+    parser.add_argument("--tokens", type=int, default=256, help="1回の生成トークン数（本番は1024）")
+    parser.add_argument("--runs", type=int, default=2, help="設定ごとの計測回数（中央値を使う）")
+    parser.add_argument("--prompt", default=BENCH_PROMPT)
+    parser.add_argument("--no-save", action="store_true", help="聴き比べ用の WAV を保存しない")
+    args = parser.parse_args()
+
+    print(f"⏳ {args.model} を CPU に読み込み中...")
+    base = load_pipeline(args.model, device=-1, cpu_options={"quantize": False})
+    import torch
+    default_threads = torch.get_num_threads()
+    os.makedirs(BENCH_OUT_DIR, exist_ok=True)
+
+    # 速度比はいつも fp32（最初のスレッド数）に対して出す。指定に無くても fp32 を最初に測る
+    configs = ["fp32"] + [name for name in args.configs if name != "fp32"]
+    baseline = None
+    print(f"{'設定':<10} {'スレッド':>6} {'秒':>8} {'tokens/s':>9} {'実時間比':>8} {'対fp32':>6}")
+    for threads in args.threads:
+        for name in configs:
+            if name == "fp32" and "fp32" not in args.configs and baseline is not None:
+                continue
+            elapsed, audio_sec, audio, rate = run_config(base, name, threads or default_threads, args.tokens, args.runs, args.prompt)
+            if baseline is None:
+                baseline = elapsed
+            # 実時間比 = 生成にかかった秒 / できた音声の秒（1 未満なら再生より速い）
+            print(f"{name:<10} {threads or default_threads:>6} {elapsed:>8.2f} {args.tokens / elapsed:>9.1f} "
+                  f"{elapsed / audio_sec:>8.2f} {baseline / elapsed:>5.2f}x")
+            if not args.no_save:
+                sf.write(os.path.join(BENCH_OUT_DIR, f"{name}_t{threads or 'default'}.wav"), audio, rate)
+    if not args.no_save:
+        print(f"🎧 聴き比べ用の WAV を {BENCH_OUT_DIR} に保存しました")
+
+
+if __name__ == "__main__":
+    main()
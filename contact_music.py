@@ -1,6 +1,6 @@
 import os
 import numpy as np
-from transformers import pipeline
+from musicgen_server import connect
 import soundfile as sf
 import sounddevice as sd
 import traceback
@@ -15,21 +15,16 @@ try:
     segment_files = []
 
     # 1. MusicGenで音楽を生成＆保存
-    pipe = pipeline("text-to-audio", model="facebook/musicgen-small")
+    musicgen = connect()
 
     for i in range(num_segments):
         print(f"Generating segment {i+1} / {num_segments} ...")
-        audio = pipe(prompt, forward_params={"do_sample": True, "max_new_tokens": int(duration * 50)})
-        print(f"audio['audio'] type: {type(audio['audio'])}")
-        print(f"audio['audio'] shape: {np.array(audio['audio']).shape}")
-        audio_data = np.array(audio["audio"])
-        # 2次元の場合は1次元にする
-        if audio_data.ndim > 1:
-            audio_data = audio_data.squeeze()
+        audio_data, sampling_rate = musicgen.generate_batch([prompt], int(duration * 50), 1)[0]
+        print(f"audio shape: {audio_data.shape}")
         # float32 → int16に変換して保存
         audio_int16 = (audio_data * 32767).astype(np.int16)
         fname = f"output/music_{i+1:03d}.wav"
-        sf.write(fname, audio_int16, audio["sampling_rate"])
+        sf.write(fname, audio_int16, sampling_rate)
         segment_files.append(fname)
     print("各セグメントの音楽ファイルを保存しました。")
 
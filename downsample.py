@@ -0,0 +1,44 @@
+import numpy as np
+
+
+# ==== LTTB（Largest-Triangle-Three-Buckets）間引き ====
+def lttb_indices(x, y, n_out):
+    """形を保ったまま n_out 点に間引くときに残すインデックスを返す（先頭・末尾は必ず残る）"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+    n = len(x)
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1])
+
+    # 先頭・末尾を除いた点を n_out-2 個のバケツに分ける
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    out = np.empty(n_out, dtype=np.int64)
+    out[0] = 0
+    out[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # 次のバケツの平均点（最後のバケツの次は末尾の点）
+        if i + 2 < len(edges):
+            nlo, nhi = edges[i + 1], edges[i + 2]
+            avg_x = x[nlo:nhi].mean()
+            avg_y = y[nlo:nhi].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        # 前回選んだ点・候補点・次バケツ平均の三角形が最大になる点を選ぶ
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+
+def downsample_indices(x, series, max_points):
+    """複数系列（心拍・RMSSD）それぞれの LTTB 結果を合わせ、共通の x で描けるインデックスにする"""
+    n = len(x)
+    if max_points is None or n <= max_points:
+        return np.arange(n)
+    per_series = max(max_points // max(len(series), 1), 3)
+    picked = [lttb_indices(x, y, per_series) for y in series]
+    return np.unique(np.concatenate(picked))
@@ -0,0 +1,493 @@
+import csv
+import gzip
+import itertools
+import json
+import os
+import shutil
+import sys
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import numpy as np
+
+# ==== バイナリログ形式 ====
+# <name>.hrl : ヘッダー(16バイト) + 固定長レコードの追記のみ
+# <name>.rr  : RR間隔（float32, ms）を詰めて並べたもの。レコードの rr_start/rr_count で参照する
+# <name>.idx : パーティションの索引（JSON。最小/最大時刻・行数・N行ごとの時刻とバイト位置）
+# 古いパーティションは <name>.hrl.gz / <name>.rr.gz に圧縮できる（索引はそのまま使える）
+MAGIC = b"HRLOG1\0\0"
+HEADER_SIZE = 16
+
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("heart_rate", "<u2"),
+    ("rr_start", "<u8"),
+    ("rr_count", "u1"),
+    ("rmssd", "<f4"),
+    ("emotion", "u1"),
+])
+RR_DTYPE = np.dtype("<f4")
+
+# 感情コード（uint8）↔ ラベル
+EMOTIONS = ["分類不能", "緊張系", "鎮静系", "落ち込み系"]
+EMOTION_CODES = {name: code for code, name in enumerate(EMOTIONS)}
+CSV_HEADER = ["timestamp", "heart_rate", "rr_ms", "rmssd", "emotion"]
+
+# ==== パーティション設定 ====
+PARTITION = "hour"     # "hour" または "day"（日本時間で区切る）
+INDEX_EVERY = 256      # 索引に時刻とバイト位置を残す間隔（行）
+JST = ZoneInfo("Asia/Tokyo")
+PARTITION_FORMATS = {"hour": "%Y%m%d_%H", "day": "%Y%m%d"}
+
+
+def rr_path_for(path):
+    if path.endswith(".gz"):
+        return os.path.splitext(path[:-3])[0] + ".rr.gz"
+    return os.path.splitext(path)[0] + ".rr"
+
+
+def partition_name(timestamp, partition=PARTITION):
+    return datetime.fromtimestamp(timestamp, JST).strftime(PARTITION_FORMATS[partition])
+
+
+def row_offset(row):
+    return HEADER_SIZE + row * RECORD_DTYPE.itemsize
+
+
+def _header():
+    return MAGIC + np.array([RECORD_DTYPE.itemsize, 0], dtype="<u4").tobytes()
+
+
+# ==== 書き込み ====
+class BinaryLogWriter:
+    """1行ごとに固定長レコードを追記する。RR は先に .rr へ書くので、レコードが指す先は常に存在する"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rr_path = rr_path_for(path)
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.f = open(path, "ab")
+        self.rr_f = open(self.rr_path, "ab")
+        if new:
+            self.f.write(_header())
+        self.rr_count = self.rr_f.tell() // RR_DTYPE.itemsize
+
+    def append(self, timestamp, heart_rate, rr_values, rmssd, emotion):
+        self.append_many([(timestamp, heart_rate, rr_values, rmssd, emotion)])
+
+    def append_many(self, rows):
+        """(timestamp, heart_rate, rr_values, rmssd, emotion) のリストをまとめて書く"""
+        if not rows:
+            return
+        records = np.zeros(len(rows), dtype=RECORD_DTYPE)
+        rr_all = []
+        for i, (timestamp, heart_rate, rr_values, rmssd, emotion) in enumerate(rows):
+            rr_values = list(rr_values)[:255]
+            rec = records[i]
+            rec["timestamp"] = timestamp
+            rec["heart_rate"] = heart_rate
+            rec["rr_start"] = self.rr_count + len(rr_all)
+            rec["rr_count"] = len(rr_values)
+            rec["rmssd"] = rmssd
+            rec["emotion"] = EMOTION_CODES.get(emotion, 0)
+            rr_all.extend(rr_values)
+        self.rr_f.write(np.asarray(rr_all, dtype=RR_DTYPE).tobytes())
+        self.rr_count += len(rr_all)
+        self.f.write(records.tobytes())
+
+    def flush(self):
+        self.rr_f.flush()
+        self.f.flush()
+
+    def fsync(self):
+        self.flush()
+        os.fsync(self.rr_f.fileno())
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.flush()
+        self.rr_f.close()
+        self.f.close()
+
+
+# ==== 読み込み ====
+class LogReader:
+    """ログファイルをメモリマップし、各列をコピーなしの NumPy ビューとして返す。
+    refresh() で追記分を取り込む（書き込み途中の半端なレコードは無視）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rr_path = rr_path_for(path)
+        self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        self.rr = np.zeros(0, dtype=RR_DTYPE)
+        self.refresh()
+
+    def refresh(self):
+        """新しいレコードがあれば True"""
+        if not os.path.exists(self.path):
+            changed = len(self.records) > 0
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+            self.rr = np.zeros(0, dtype=RR_DTYPE)
+            return changed
+        if self.path.endswith(".gz"):
+            return self._load_compressed()
+        size = os.path.getsize(self.path)
+        n = max(size - HEADER_SIZE, 0) // RECORD_DTYPE.itemsize
+        if n == len(self.records):
+            return False
+        if n == 0:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        else:
+            with open(self.path, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise ValueError(f"{self.path} はバイナリログではありません")
+            self.records = np.memmap(self.path, dtype=RECORD_DTYPE, mode="r",
+                                     offset=HEADER_SIZE, shape=(n,))
+        rr_n = os.path.getsize(self.rr_path) // RR_DTYPE.itemsize if os.path.exists(self.rr_path) else 0
+        self.rr = (np.memmap(self.rr_path, dtype=RR_DTYPE, mode="r", shape=(rr_n,))
+                   if rr_n else np.zeros(0, dtype=RR_DTYPE))
+        return True
+
+    def _load_compressed(self):
+        # 圧縮済み（＝もう追記されない）パーティションは一度だけ展開する
+        if len(self.records):
+            return False
+        with gzip.open(self.path, "rb") as f:
+            raw = f.read()
+        if raw[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} はバイナリログではありません")
+        n = (len(raw) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+        self.records = np.frombuffer(raw, dtype=RECORD_DTYPE, count=n, offset=HEADER_SIZE)
+        if os.path.exists(self.rr_path):
+            with gzip.open(self.rr_path, "rb") as f:
+                self.rr = np.frombuffer(f.read(), dtype=RR_DTYPE)
+        return True
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def timestamps(self):
+        return self.records["timestamp"]
+
+    @property
+    def heart_rate(self):
+        return self.records["heart_rate"]
+
+    @property
+    def rmssd(self):
+        return self.records["rmssd"]
+
+    @property
+    def emotion_codes(self):
+        return self.records["emotion"]
+
+    def rr_values(self, i):
+        rec = self.records[i]
+        start = int(rec["rr_start"])
+        return self.rr[start:start + int(rec["rr_count"])]
+
+
+# ==== 索引 ====
+def index_path_for(path):
+    if path.endswith(".gz"):
+        path = path[:-3]
+    return os.path.splitext(path)[0] + ".idx"
+
+
+def new_index(every=INDEX_EVERY):
+    return {"min_ts": None, "max_ts": None, "rows": 0, "every": every,
+            "record_size": RECORD_DTYPE.itemsize, "checkpoints": []}
+
+
+def index_add(index, first_row, timestamps):
+    """first_row 行目から始まる timestamps を索引に反映する"""
+    if not len(timestamps):
+        return
+    every = index["every"]
+    for k, ts in enumerate(timestamps):
+        row = first_row + k
+        if row % every == 0:
+            index["checkpoints"].append([float(ts), row_offset(row)])
+    lo, hi = float(min(timestamps)), float(max(timestamps))
+    index["min_ts"] = lo if index["min_ts"] is None else min(index["min_ts"], lo)
+    index["max_ts"] = hi if index["max_ts"] is None else max(index["max_ts"], hi)
+    index["rows"] = first_row + len(timestamps)
+
+
+def build_index(path, every=INDEX_EVERY):
+    """データファイルから索引を作り直す（索引が無い・古いとき）"""
+    index = new_index(every)
+    index_add(index, 0, LogReader(path).timestamps.tolist())
+    return index
+
+
+def write_index(path, index):
+    idx_path = index_path_for(path)
+    tmp = idx_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp, idx_path)
+
+
+def read_index(path):
+    try:
+        with open(index_path_for(path), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# ==== 時間パーティション書き込み ====
+class PartitionedLogWriter:
+    """タイムスタンプから決まる1時間（または1日）ごとのファイルへ書き分け、索引も更新する。
+    BinaryLogWriter と同じ append_many/flush/fsync/close を持つ"""
+
+    def __init__(self, directory, partition=PARTITION, index_every=INDEX_EVERY, compress_closed=False):
+        self.directory = directory
+        self.partition = partition
+        self.index_every = index_every
+        self.compress_closed = compress_closed
+        self.name = None
+        self.writer = None
+        self.index = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + ".hrl")
+
+    def _switch(self, name):
+        if name == self.name:
+            return
+        self._close_current()
+        path = self._path(name)
+        if os.path.exists(path + ".gz"):
+            # 圧縮済みの時間帯に遅れて届いた行 → 展開して追記を続ける
+            decompress_partition(path)
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.writer = BinaryLogWriter(path)
+        index = read_index(path) if exists else None
+        if exists and (index is None or index["rows"] != len(LogReader(path))):
+            index = build_index(path, self.index_every)
+        self.index = index or new_index(self.index_every)
+        self.name = name
+
+    def _close_current(self):
+        if self.writer is None:
+            return
+        path = self.writer.path
+        self.writer.close()
+        write_index(path, self.index)
+        self.writer = None
+        self.name = None
+        if self.compress_closed:
+            compress_partition(path)
+
+    def append_many(self, rows):
+        for name, group in itertools.groupby(rows, key=lambda r: partition_name(r[0], self.partition)):
+            group = list(group)
+            self._switch(name)
+            first_row = self.index["rows"]
+            self.writer.append_many(group)
+            index_add(self.index, first_row, [r[0] for r in group])
+
+    def append(self, timestamp, heart_rate, rr_values, rmssd, emotion):
+        self.append_many([(timestamp, heart_rate, rr_values, rmssd, emotion)])
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+            write_index(self.writer.path, self.index)
+
+    def fsync(self):
+        if self.writer is not None:
+            self.writer.fsync()
+            write_index(self.writer.path, self.index)
+
+    def close(self):
+        self._close_current()
+
+
+def compress_partition(path):
+    """閉じたパーティションを gzip 圧縮する（索引は圧縮前の行位置のまま有効）"""
+    for src in (path, rr_path_for(path)):
+        if not os.path.exists(src):
+            continue
+        with open(src, "rb") as fin, gzip.open(src + ".gz", "wb") as fout:
+            shutil.copyfileobj(fin, fout)
+        os.remove(src)
+
+
+def decompress_partition(path):
+    for dst in (path, rr_path_for(path)):
+        src = dst + ".gz"
+        if not os.path.exists(src):
+            continue
+        with gzip.open(src, "rb") as fin, open(dst, "wb") as fout:
+            shutil.copyfileobj(fin, fout)
+        os.remove(src)
+
+
+# ==== 時間パーティション読み込み ====
+class PartitionedLog:
+    """ディレクトリ内のパーティションを索引で絞り込み、必要なファイルの必要な行だけを読む"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.readers = {}   # パーティション名 → LogReader
+        self.indexes = {}   # パーティション名 → (データファイルのサイズ, 索引)
+
+    def partitions(self):
+        """[(名前, パス)]（古い順）"""
+        if not os.path.isdir(self.directory):
+            return []
+        found = {}
+        for fname in os.listdir(self.directory):
+            if fname.endswith(".hrl"):
+                found[fname[:-4]] = fname
+            elif fname.endswith(".hrl.gz"):
+                found.setdefault(fname[:-7], fname)
+        return [(name, os.path.join(self.directory, found[name])) for name in sorted(found)]
+
+    def index(self, name, path):
+        size = os.path.getsize(path)
+        cached = self.indexes.get(name)
+        if cached and cached[0] == size:
+            return cached[1]
+        index = cached[1] if cached else read_index(path)
+        if index is None:
+            index = build_index(path)
+        elif not path.endswith(".gz"):
+            # 索引が書かれた後に追記された分だけ足す
+            reader = self.reader(name, path)
+            if index["rows"] < len(reader):
+                index_add(index, index["rows"], reader.timestamps[index["rows"]:].tolist())
+        self.indexes[name] = (size, index)
+        return index
+
+    def reader(self, name, path):
+        r = self.readers.get(name)
+        if r is None or r.path != path:
+            r = self.readers[name] = LogReader(path)
+        else:
+            r.refresh()
+        return r
+
+    def earliest_timestamp(self):
+        for name, path in self.partitions():
+            index = self.index(name, path)
+            if index["rows"]:
+                return index["min_ts"]
+        return None
+
+    def latest_timestamp(self):
+        for name, path in reversed(self.partitions()):
+            index = self.index(name, path)
+            if index["rows"]:
+                return index["max_ts"]
+        return None
+
+    def read_range(self, t_from=None, t_to=None):
+        """[t_from, t_to] のレコード（RECORD_DTYPE の配列）を返す。1パーティションで済めばコピーなし"""
+        parts = []
+        for name, path in self.partitions():
+            index = self.index(name, path)
+            if not index["rows"]:
+                continue
+            if t_from is not None and index["max_ts"] < t_from:
+                continue
+            if t_to is not None and index["min_ts"] > t_to:
+                continue
+            lo, hi = 0, index["rows"]
+            # 索引の区切りで範囲を絞ってから、その中だけを二分探索
+            for ts, offset in index["checkpoints"]:
+                row = (offset - HEADER_SIZE) // RECORD_DTYPE.itemsize
+                if t_from is not None and ts < t_from:
+                    lo = row
+                if t_to is not None and ts > t_to:
+                    hi = row
+                    break
+            records = self.reader(name, path).records[lo:hi]
+            ts = records["timestamp"]
+            a = 0 if t_from is None else int(np.searchsorted(ts, t_from, side="left"))
+            b = len(ts) if t_to is None else int(np.searchsorted(ts, t_to, side="right"))
+            if b > a:
+                parts.append(records[a:b])
+        if not parts:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def emotion_labels(codes):
+    """感情コード配列 → ラベルのリスト"""
+    return np.asarray(EMOTIONS, dtype=object)[np.asarray(codes)].tolist()
+
+
+# ==== CSV との相互変換 ====
+def export_csv(directory, csv_path):
+    """パーティション化されたログを従来の emotion_log.csv と同じ列構成で書き出す"""
+    log = PartitionedLog(directory)
+    count = 0
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for _, path in log.partitions():
+            reader = LogReader(path)
+            for i, rec in enumerate(reader.records):
+                writer.writerow([
+                    float(rec["timestamp"]),
+                    int(rec["heart_rate"]),
+                    reader.rr_values(i).tolist(),
+                    f"{rec['rmssd']:.2f}",
+                    EMOTIONS[rec["emotion"]]
+                ])
+            count += len(reader)
+    return count
+
+
+def import_csv(csv_path, directory):
+    """既存の emotion_log.csv をパーティション化したバイナリログへ追記する"""
+    rows = []
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            try:
+                rows.append((
+                    float(row["timestamp"]),
+                    int(float(row["heart_rate"])),
+                    json.loads(row["rr_ms"]),
+                    float(row["rmssd"]),
+                    row["emotion"]
+                ))
+            except (ValueError, TypeError):
+                continue
+    rows.sort(key=lambda r: r[0])
+    writer = PartitionedLogWriter(directory)
+    writer.append_many(rows)
+    writer.close()
+    return len(rows)
+
+
+def compress_older_than(directory, hours):
+    """最終更新から hours 時間以上たった未圧縮パーティションを圧縮する（最新のものは書き込み中なので除く）"""
+    log = PartitionedLog(directory)
+    limit = datetime.now().timestamp() - hours * 3600
+    count = 0
+    for _, path in log.partitions()[:-1]:
+        if path.endswith(".hrl") and os.path.getmtime(path) < limit:
+            compress_partition(path)
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    # python hr_log.py import emotion_log.csv logs/coospo
+    # python hr_log.py export logs/coospo emotion_log.csv
+    # python hr_log.py compress logs/coospo 24
+    if len(sys.argv) != 4 or sys.argv[1] not in ("import", "export", "compress"):
+        print("使い方: python hr_log.py import <csv> <ログDir> | export <ログDir> <csv> | compress <ログDir> <経過時間h>")
+        sys.exit(1)
+    if sys.argv[1] == "import":
+        print(f"✅ {import_csv(sys.argv[2], sys.argv[3])} 行を取り込みました")
+    elif sys.argv[1] == "export":
+        print(f"✅ {export_csv(sys.argv[2], sys.argv[3])} 行を書き出しました")
+    else:
+        print(f"✅ {compress_older_than(sys.argv[2], float(sys.argv[3]))} 個のパーティションを圧縮しました")
@@ -0,0 +1,191 @@
+import os
+import struct
+import sys
+import time
+import numpy as np
+from hr_log import partition_name, PARTITION
+
+# ==== Heart Rate Measurement（0x2A37）のフラグ ====
+FLAG_HR_UINT16 = 0x01   # 心拍が2バイト
+FLAG_ENERGY = 0x08      # Energy Expended（2バイト）あり
+FLAG_RR = 0x10          # RR間隔（1/1024秒単位の2バイト値が続く）あり
+
+# ==== 生パケットの保存形式 ====
+# logs/<デバイス名>/capture/<日時>.hrc : ヘッダー(16バイト) + 固定長レコード
+PACKET_MAX = 23  # ATT MTU 23 の通知ペイロード上限。超えた分は切り捨てる
+MAGIC = b"HRCAP1\0\0"
+HEADER_SIZE = 16
+CAPTURE_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("length", "u1"),
+    ("payload", "u1", (PACKET_MAX,)),
+])
+
+
+def rr_to_ms(rr):
+    return rr / 1024 * 1000
+
+
+# ==== 1パケットのデコード（ライブ用） ====
+def decode_packet(data):
+    """(心拍, [RR ms]) を返す。16bit心拍・Energy Expended の有無に応じて RR の位置をずらす"""
+    data = bytes(data)
+    if len(data) < 2:
+        return None, []
+    flags = data[0]
+    if flags & FLAG_HR_UINT16:
+        if len(data) < 3:
+            return None, []
+        hr = data[1] | (data[2] << 8)
+        offset = 3
+    else:
+        hr = data[1]
+        offset = 2
+    if flags & FLAG_ENERGY:
+        offset += 2
+    if not flags & FLAG_RR or offset >= len(data):
+        return hr, []
+    n = (len(data) - offset) // 2
+    return hr, [rr_to_ms(rr) for rr in struct.unpack_from(f"<{n}H", data, offset)]
+
+
+# ==== まとめてデコード（オフライン用） ====
+def decode_capture(records):
+    """CAPTURE_DTYPE の配列を一括デコードする。
+    戻り値: dict(hr, energy, rr_ms, rr_packet, rr_count)
+    rr_packet は各RRが何番目のパケット由来か、rr_count はパケットごとのRR数"""
+    payload = records["payload"].astype(np.int64)
+    length = records["length"].astype(np.int64)
+    n = len(records)
+    flags = payload[:, 0]
+    hr16 = (flags & FLAG_HR_UINT16) != 0
+    has_energy = (flags & FLAG_ENERGY) != 0
+    has_rr = (flags & FLAG_RR) != 0
+    rows = np.arange(n)
+
+    hr = np.where(hr16, payload[:, 1] | (payload[:, 2] << 8), payload[:, 1])
+    energy_at = np.where(hr16, 3, 2)
+    energy = np.where(has_energy,
+                      payload[rows, np.minimum(energy_at, PACKET_MAX - 2)]
+                      | (payload[rows, np.minimum(energy_at + 1, PACKET_MAX - 1)] << 8),
+                      -1)
+    rr_at = energy_at + np.where(has_energy, 2, 0)
+    rr_count = np.where(has_rr, np.maximum(length - rr_at, 0) // 2, 0)
+
+    # 最大RR数の分だけ列をずらして読み、有効なところだけ取り出す
+    max_rr = int(rr_count.max()) if n else 0
+    k = np.arange(max_rr)
+    cols = rr_at[:, None] + 2 * k[None, :]
+    valid = k[None, :] < rr_count[:, None]
+    cols = np.minimum(cols, PACKET_MAX - 2)
+    raw = payload[rows[:, None], cols] | (payload[rows[:, None], cols + 1] << 8)
+    return {
+        "hr": hr,
+        "energy": energy,
+        "rr_ms": rr_to_ms(raw[valid].astype(np.float64)),
+        "rr_packet": np.broadcast_to(rows[:, None], valid.shape)[valid],
+        "rr_count": rr_count,
+    }
+
+
+def rolling_rmssd(rr_ms, window=10):
+    """直近 window 拍の RMSSD を全拍について一括計算（window 拍たまる前は NaN）"""
+    rr_ms = np.asarray(rr_ms, dtype=np.float64)
+    out = np.full(len(rr_ms), np.nan)
+    if len(rr_ms) < window:
+        return out
+    sq = np.diff(rr_ms) ** 2
+    csum = np.concatenate([[0.0], np.cumsum(sq)])
+    # i 拍目で終わる窓の差分は sq[i-window+1 : i]（window-1 個）
+    ends = np.arange(window - 1, len(rr_ms))
+    out[window - 1:] = np.sqrt((csum[ends] - csum[ends - window + 1]) / (window - 1))
+    return out
+
+
+# ==== 生パケットの保存 ====
+class CaptureWriter:
+    """(timestamp, bytes) を時間パーティションごとのファイルへ固定長で追記する"""
+
+    def __init__(self, directory, partition=PARTITION):
+        self.directory = os.path.join(directory, "capture")
+        self.partition = partition
+        self.name = None
+        self.f = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _switch(self, name):
+        if name == self.name:
+            return
+        self.close()
+        path = os.path.join(self.directory, name + ".hrc")
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.f = open(path, "ab")
+        if new:
+            self.f.write(MAGIC + np.array([CAPTURE_DTYPE.itemsize, 0], dtype="<u4").tobytes())
+        self.name = name
+
+    def append_many(self, packets):
+        if not packets:
+            return
+        records = np.zeros(len(packets), dtype=CAPTURE_DTYPE)
+        for i, (timestamp, data) in enumerate(packets):
+            data = bytes(data)[:PACKET_MAX]
+            records["timestamp"][i] = timestamp
+            records["length"][i] = len(data)
+            records["payload"][i, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+        # パーティションの切り替わりで分けて書く
+        names = [partition_name(ts, self.partition) for ts in records["timestamp"].tolist()]
+        start = 0
+        for i in range(1, len(names) + 1):
+            if i == len(names) or names[i] != names[start]:
+                self._switch(names[start])
+                self.f.write(records[start:i].tobytes())
+                start = i
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def fsync(self):
+        if self.f is not None:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            self.name = None
+
+
+def read_capture(directory):
+    """保存済みの生パケットを古い順に全部読む（メモリマップ）"""
+    capture_dir = os.path.join(directory, "capture")
+    if not os.path.isdir(capture_dir):
+        return np.zeros(0, dtype=CAPTURE_DTYPE)
+    parts = []
+    for fname in sorted(os.listdir(capture_dir)):
+        if not fname.endswith(".hrc"):
+            continue
+        path = os.path.join(capture_dir, fname)
+        n = max(os.path.getsize(path) - HEADER_SIZE, 0) // CAPTURE_DTYPE.itemsize
+        if n:
+            parts.append(np.memmap(path, dtype=CAPTURE_DTYPE, mode="r", offset=HEADER_SIZE, shape=(n,)))
+    if not parts:
+        return np.zeros(0, dtype=CAPTURE_DTYPE)
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+if __name__ == "__main__":
+    # python hrm_packets.py logs/coospo  → 生パケットから心拍・RR・RMSSD を一括で出し直す
+    if len(sys.argv) != 2:
+        print("使い方: python hrm_packets.py <ログDir>")
+        sys.exit(1)
+    t0 = time.perf_counter()
+    records = read_capture(sys.argv[1])
+    decoded = decode_capture(records)
+    rmssd = rolling_rmssd(decoded["rr_ms"])
+    elapsed = time.perf_counter() - t0
+    print(f"✅ {len(records)} パケット / RR {len(decoded['rr_ms'])} 拍を {elapsed:.3f} 秒でデコード")
+    if len(decoded["rr_ms"]):
+        print(f"📈 RMSSD(10拍) 中央値: {np.nanmedian(rmssd):.2f} ms")
@@ -0,0 +1,137 @@
+import math
+
+# ==== 設定 ====
+# 窓の種類：("beats", 拍数) または ("ms", 時間幅ミリ秒)
+DEFAULT_WINDOWS = {
+    "10beats": ("beats", 10),
+    "30s": ("ms", 30_000),
+    "5min": ("ms", 300_000),
+}
+MIN_BEATS = 4            # これ未満の窓では指標を出さない（従来の rr_list >= 4 と同じ）
+MAX_HR_BPM = 240         # 時間窓のリング容量を決めるための上限心拍数
+
+
+# ==== 1つの窓 ====
+class RollingRR:
+    """固定容量のリングバッファにRR間隔を保持し、RMSSD/SDNN/pNN50 用の和を差分更新する。
+    追加・追い出しとも O(1)。誤差が溜まらないよう容量分追加するたびに和を計算し直す"""
+
+    def __init__(self, max_beats=None, max_ms=None):
+        if max_beats is None and max_ms is None:
+            raise ValueError("max_beats か max_ms のどちらかを指定してください")
+        if max_beats is None:
+            max_beats = int(max_ms / 60_000 * MAX_HR_BPM) + 2
+        self.max_beats = max_beats
+        self.max_ms = max_ms
+        self.buf = [0.0] * max_beats
+        self.head = 0   # 最古の要素の位置
+        self.size = 0
+        self.pushes = 0
+        self._zero_sums()
+
+    def _zero_sums(self):
+        self.sum_rr = 0.0
+        self.sum_rr2 = 0.0
+        self.sum_sqdiff = 0.0
+        self.nn50 = 0
+
+    def _at(self, i):
+        return self.buf[(self.head + i) % self.max_beats]
+
+    def _evict(self):
+        old = self.buf[self.head]
+        if self.size > 1:
+            d = self._at(1) - old
+            self.sum_sqdiff -= d * d
+            self.nn50 -= abs(d) > 50
+        self.sum_rr -= old
+        self.sum_rr2 -= old * old
+        self.head = (self.head + 1) % self.max_beats
+        self.size -= 1
+
+    def push(self, rr):
+        if self.size == self.max_beats:
+            self._evict()
+        if self.size > 0:
+            d = rr - self._at(self.size - 1)
+            self.sum_sqdiff += d * d
+            self.nn50 += abs(d) > 50
+        self.buf[(self.head + self.size) % self.max_beats] = rr
+        self.size += 1
+        self.sum_rr += rr
+        self.sum_rr2 += rr * rr
+        # 時間窓：合計時間が幅を超えた分を古い方から落とす
+        if self.max_ms is not None:
+            while self.size > 1 and self.sum_rr > self.max_ms:
+                self._evict()
+        self.pushes += 1
+        if self.pushes % self.max_beats == 0:
+            self._recompute()
+
+    def _recompute(self):
+        self._zero_sums()
+        prev = None
+        for i in range(self.size):
+            rr = self._at(i)
+            self.sum_rr += rr
+            self.sum_rr2 += rr * rr
+            if prev is not None:
+                d = rr - prev
+                self.sum_sqdiff += d * d
+                self.nn50 += abs(d) > 50
+            prev = rr
+
+    def metrics(self):
+        n = self.size
+        if n < MIN_BEATS:
+            return None
+        mean_rr = self.sum_rr / n
+        var = max(self.sum_rr2 - n * mean_rr * mean_rr, 0.0) / (n - 1)
+        return {
+            "rmssd": math.sqrt(max(self.sum_sqdiff, 0.0) / (n - 1)),
+            "sdnn": math.sqrt(var),
+            "pnn50": 100.0 * self.nn50 / (n - 1),
+            "mean_hr": 60_000.0 / mean_rr if mean_rr > 0 else None,
+            "beats": n,
+        }
+
+
+# ==== 複数窓をまとめて更新 ====
+class HRVEngine:
+    """RR間隔1つごとに全窓を同時に更新する。メモリは窓の容量で頭打ち"""
+
+    def __init__(self, windows=None, short_window="10beats"):
+        windows = windows or DEFAULT_WINDOWS
+        self.windows = {}
+        for name, (kind, size) in windows.items():
+            if kind == "beats":
+                self.windows[name] = RollingRR(max_beats=size)
+            else:
+                self.windows[name] = RollingRR(max_ms=size)
+        self.short_window = short_window
+
+    def add(self, rr_values):
+        for rr in rr_values:
+            for w in self.windows.values():
+                w.push(rr)
+
+    def metrics(self):
+        return {name: w.metrics() for name, w in self.windows.items()}
+
+    def rmssd(self):
+        """感情分類に使う短い窓の RMSSD（まだ拍数が足りなければ None）"""
+        m = self.windows[self.short_window].metrics()
+        return m["rmssd"] if m else None
+
+
+# ==== 感情分類 ====
+def classify_emotion(hr_value, rmssd):
+    if rmssd is None:
+        return "分類不能"
+    if hr_value >= 85 and rmssd < 30:
+        return "緊張系"
+    if hr_value <= 65 and rmssd < 30:
+        return "落ち込み系"
+    if rmssd >= 30:
+        return "鎮静系"
+    return "分類不能"
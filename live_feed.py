@@ -0,0 +1,79 @@
+import json
+import queue
+import socket
+import threading
+
+# ==== 設定 ====
+# 心拍取得スクリプト → WebUI へのローカル送信先（UDP）
+LIVE_ADDR = ("127.0.0.1", 8765)
+
+
+# ==== 送信側（step1_get_heart_rate.py） ====
+class LivePublisher:
+    """1サンプルを1データグラムで投げるだけ。受信側がいなくても止まらない"""
+
+    def __init__(self, addr=LIVE_ADDR):
+        self.addr = addr
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def publish(self, sample):
+        try:
+            self.sock.sendto(json.dumps(sample).encode("utf-8"), self.addr)
+        except OSError:
+            # WebUI 未起動・バッファ満杯などは無視（ログは別に残る）
+            pass
+
+
+# ==== 受信側（WebUI.py） ====
+class LiveHub:
+    """UDPで受けたサンプルを購読中の各クライアントのキューへ配る"""
+
+    def __init__(self, addr=LIVE_ADDR, max_queue=1000):
+        self.addr = addr
+        self.max_queue = max_queue
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._recv_loop, daemon=True)
+            self.thread.start()
+
+    def _recv_loop(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(self.addr)
+        except OSError as e:
+            print(f"⚠️ ライブ受信ポート {self.addr} を開けません: {e}")
+            return
+        while True:
+            payload, _ = sock.recvfrom(65536)
+            try:
+                sample = json.loads(payload.decode("utf-8"))
+            except ValueError:
+                continue
+            self.broadcast(sample)
+
+    def broadcast(self, sample):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(sample)
+            except queue.Full:
+                # 読まないクライアントのために溜め込まない
+                pass
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=self.max_queue)
+        with self.lock:
+            self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
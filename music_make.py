@@ -1,18 +1,22 @@
+import argparse
+import hashlib
+import json
 import os
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import soundfile as sf
-from transformers import pipeline
-import torch
+from audio_dsp import apply_fade
+from musicgen_server import PRIORITY_LIBRARY, MusicGenClient, connect
 
-# 保存先
-os.makedirs("output", exist_ok=True)
-
-# GPUが使える場合はcuda:0、なければcpu
-device = 0 if torch.cuda.is_available() else -1
-
-# MusicGenパイプライン（GPU指定！）
-pipe = pipeline("text-to-audio", model="facebook/musicgen-small", device=device)
+# ==== 設定 ====
+OUTPUT_DIR = "output"
+MANIFEST_PATH = "output/presets.json"  # 各ループを何で作ったか（プロンプト・シード・トークン数・ハッシュ…）
+TOKENS = 1024
+BATCH_SIZE = 4   # 1回のモデル呼び出しでまとめて作る曲数
+WORKERS = 2      # 同時に投げる依頼数（推論サーバー使用時）
 
 preset_prompts = {
     "relax": [
@@ -39,23 +43,139 @@ num_per_emotion = {
     "sad": 2
 }
 
-for emotion, prompts in preset_prompts.items():
-    for i in range(num_per_emotion[emotion]):
-        prompt = random.choice(prompts)
-        print(f"{emotion} のプリセットBGM {i+1}曲目生成: {prompt}")
-        audio = pipe(prompt, forward_params={"do_sample": True, "max_new_tokens": 1024})
-        if isinstance(audio, list):
-            audio = audio[0]
-        audio_data = np.squeeze(audio["audio"])
-        # ショートフェードでつなぎも滑らかに
-        def fade(data, fade_len=3000):
-            if data.dtype != np.float32 and data.dtype != np.float64:
-                data = data.astype(np.float32)
-            fadein = np.linspace(0, 1, min(fade_len, len(data)))
-            fadeout = np.linspace(1, 0, min(fade_len, len(data)))
-            data[:len(fadein)] *= fadein
-            data[-len(fadeout):] *= fadeout
-            return data
-        audio_data = fade(audio_data)
-        sf.write(f"output/loop_{emotion}{i+1}.wav", (audio_data * 32767).astype(np.int16), audio["sampling_rate"])
-        print(f"output/loop_{emotion}{i+1}.wav 保存完了！\n")
+
+# ==== 作るもの一覧と manifest ====
+def plan_entries(counts):
+    """感情ごとに counts 曲ぶんの (ファイル, プロンプト, シード) を決める。何度呼んでも同じ結果になる"""
+    entries = []
+    for emotion, prompts in preset_prompts.items():
+        for i in range(counts.get(emotion, 0)):
+            entries.append({
+                "file": os.path.join(OUTPUT_DIR, f"loop_{emotion}{i+1}.wav"),
+                "emotion": emotion,
+                "prompt": random.Random(f"{emotion}:{i}").choice(prompts),
+                "seed": i,
+                "tokens": TOKENS,
+            })
+    return entries
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_manifest(path=MANIFEST_PATH):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    """途中で止まっても壊れないよう、一時ファイルに書いてから置き換える"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def is_valid(entry, manifest):
+    """manifest の記録が今の計画と同じで、ファイルも記録どおり残っているか"""
+    rec = manifest.get(entry["file"])
+    return (rec is not None
+            and rec["prompt"] == entry["prompt"]
+            and rec.get("seed") == entry["seed"]
+            and rec["tokens"] == entry["tokens"]
+            and os.path.exists(entry["file"])
+            and file_hash(entry["file"]) == rec["sha256"])
+
+
+# ==== 生成 ====
+def render_chunk(musicgen, seed, chunk, manifest, lock):
+    """chunk の曲をまとめて生成し、1曲書き終えるごとに manifest に記録する。
+    シードはバッチ全体で1つなので、chunk は seed の曲だけでできている（make_chunks）"""
+    for entry in chunk:
+        print(f"{entry['emotion']} のプリセットBGM生成: {entry['prompt']}")
+    results = musicgen.generate_batch([e["prompt"] for e in chunk], TOKENS, len(chunk),
+                                      seed=seed, priority=PRIORITY_LIBRARY)
+    for entry, (audio_data, rate) in zip(chunk, results):
+        audio_data = apply_fade(audio_data)  # ショートフェードでつなぎも滑らかに
+        tmp = entry["file"] + ".tmp"
+        sf.write(tmp, (np.clip(audio_data, -1, 1) * 32767).astype(np.int16), rate, format="WAV")
+        os.replace(tmp, entry["file"])
+        with lock:
+            manifest[entry["file"]] = {
+                "emotion": entry["emotion"],
+                "prompt": entry["prompt"],
+                "seed": entry["seed"],
+                "tokens": entry["tokens"],
+                "batch_size": len(chunk),
+                "batch": [e["prompt"] for e in chunk],
+                "sample_rate": rate,
+                "duration": len(audio_data) / rate,
+                "sha256": file_hash(entry["file"]),
+                "created": time.time(),
+            }
+            save_manifest(manifest)
+        print(f"{entry['file']} 保存完了！")
+
+
+def make_chunks(entries, batch_size):
+    """同じシードの曲どうしを batch_size 曲ずつまとめ、[(シード, 曲のリスト)] を返す（計画したシードのまま生成できる）"""
+    by_seed = {}
+    for entry in entries:
+        by_seed.setdefault(entry["seed"], []).append(entry)
+    return [(seed, group[i:i + batch_size]) for seed, group in sorted(by_seed.items())
+            for i in range(0, len(group), batch_size)]
+
+
+def build(counts, batch_size=BATCH_SIZE, workers=WORKERS):
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    manifest = load_manifest()
+    entries = plan_entries(counts)
+    missing = [e for e in entries if not is_valid(e, manifest)]
+    print(f"📋 {len(entries)} 曲中 {len(entries) - len(missing)} 曲は作成済み → {len(missing)} 曲を生成します")
+    if not missing:
+        return
+
+    # MusicGen（推論サーバーがあればそれを使う。無ければGPUが使える場合はcuda:0、なければcpuで読み込む）
+    # 同じプロンプト×シードは前回の生成結果をキャッシュから使う
+    musicgen = connect()
+    if not isinstance(musicgen, MusicGenClient) and workers > 1:
+        print("⚠️ 推論サーバーが無いので1並列で生成します")
+        workers = 1
+    lock = threading.Lock()
+    chunks = make_chunks(missing, batch_size)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(render_chunk, musicgen, seed, chunk, manifest, lock) for seed, chunk in chunks]
+        try:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"⚠️ 生成に失敗（次回の実行で作り直します）: {e}")
+        except KeyboardInterrupt:
+            print("⏹️ 中断しました（保存済みの曲は manifest に記録済み。次回は続きから作ります）")
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    print(f"✅ 完了（失敗 {failed} バッチ）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="プリセットBGMライブラリを作る（作成済みは飛ばすので途中から再開できる）")
+    parser.add_argument("--per-emotion", type=int, help="感情ごとの曲数（省略時は num_per_emotion）")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    counts = dict(num_per_emotion)
+    if args.per_emotion:
+        counts = {emotion: args.per_emotion for emotion in preset_prompts}
+    build(counts, args.batch_size, args.workers)
@@ -0,0 +1,221 @@
+import argparse
+import http.client
+import itertools
+import json
+import queue
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from musicgen_util import (CPU_MATMUL_PRECISION, CPU_QUANTIZE, CPU_THREADS, DEFAULT_BATCH_SIZE, MUSICGEN_MODEL,
+                           LocalGenerator, iter_generate, load_pipeline)
+from segment_cache import SegmentCache
+
+# ==== 設定 ====
+# モデルを1回だけ読み込んで常駐し、各スクリプトからの生成依頼を受ける（python musicgen_server.py）
+SERVER_ADDR = ("127.0.0.1", 8766)
+
+# 優先度（小さいほど先）。1セグメント生成するごとに優先度順に次の依頼を選び直す
+PRIORITY_PLAYBACK = 0   # 今から再生する曲
+PRIORITY_PREFETCH = 5   # 先読み
+PRIORITY_LIBRARY = 10   # プリセット作りなどのまとめ生成
+
+# 応答はセグメントごとのフレーム: ヘッダー(サンプル数 u4, サンプリングレート i4) + float32 PCM
+# レートが負のフレームはエラー（続く「サンプル数」バイトが UTF-8 のメッセージ）
+FRAME_HEADER = struct.Struct("<Ii")
+
+
+# ==== サーバー側 ====
+class _Job:
+    def __init__(self, params):
+        self.params = params
+        self.iterator = None
+        self.out = queue.Queue()
+        self.cancelled = False
+
+
+class MusicGenServer:
+    """依頼を優先度付きキューに積み、1つのワーカースレッドがモデルを独占して順に生成する"""
+
+    def __init__(self, addr=SERVER_ADDR, model=MUSICGEN_MODEL, device=None, cache=None, cpu_options=None):
+        self.addr = addr
+        self.model = model
+        print(f"⏳ {model} を読み込み中...")
+        self.pipe = load_pipeline(model, device, cpu_options)
+        self.cache = cache
+        self.jobs = queue.PriorityQueue()
+        self.seq = itertools.count()
+        print("✅ 読み込み完了")
+
+    def submit(self, params):
+        job = _Job(params)
+        self.jobs.put((params.get("priority", PRIORITY_PLAYBACK), next(self.seq), job))
+        return job
+
+    def _work_loop(self):
+        while True:
+            priority, seq, job = self.jobs.get()
+            if job.cancelled:
+                continue
+            p = job.params
+            if job.iterator is None:
+                job.iterator = iter_generate(self.pipe, p["prompts"], p.get("tokens", 1024),
+                                             p.get("batch_size", DEFAULT_BATCH_SIZE), p.get("do_sample", True),
+                                             p.get("seed"), self.cache)
+            try:
+                item = next(job.iterator)
+            except StopIteration:
+                job.out.put(None)
+                continue
+            except Exception as e:
+                job.out.put(e)
+                continue
+            job.out.put(item)
+            # 残りは同じ順番のまま積み直す（より優先度の高い依頼が来ていればそちらが先）
+            self.jobs.put((priority, seq, job))
+
+    def serve_forever(self):
+        threading.Thread(target=self._work_loop, daemon=True).start()
+        server = ThreadingHTTPServer(self.addr, self._handler_class())
+        server.daemon_threads = True
+        print(f"🎵 MusicGen サーバー起動: http://{self.addr[0]}:{self.addr[1]}")
+        server.serve_forever()
+
+    def _handler_class(self):
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, obj):
+                # send_error の理由文はステータス行（latin-1）に入るので、日本語のメッセージは本文で返す
+                body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != "/health":
+                    self.send_error(404)
+                    return
+                self.send_json(200, {"model": owner.model, "queue": owner.jobs.qsize()})
+
+            def do_POST(self):
+                if self.path != "/generate":
+                    self.send_error(404)
+                    return
+                try:
+                    params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    if not isinstance(params, dict):
+                        raise ValueError("JSON オブジェクトを送ってください")
+                    prompts = params.get("prompts")
+                    if not isinstance(prompts, list) or not all(isinstance(p, str) for p in prompts):
+                        raise ValueError("prompts（文字列のリスト）がありません")
+                except ValueError as e:
+                    self.send_json(400, {"error": str(e)})
+                    return
+                job = owner.submit(params)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.end_headers()
+                try:
+                    while True:
+                        item = job.out.get()
+                        if item is None:
+                            break
+                        if isinstance(item, Exception):
+                            message = f"{type(item).__name__}: {item}".encode("utf-8")
+                            self.wfile.write(FRAME_HEADER.pack(len(message), -1) + message)
+                            break
+                        audio, rate = item
+                        audio = np.ascontiguousarray(audio, dtype="<f4")
+                        self.wfile.write(FRAME_HEADER.pack(len(audio), int(rate)) + audio.tobytes())
+                        self.wfile.flush()
+                except OSError:
+                    # クライアントが切断したら残りは作らない
+                    job.cancelled = True
+
+        return Handler
+
+
+# ==== クライアント側（app.py / app2.py / music_make.py / contact_music.py） ====
+class MusicGenClient:
+    """LocalGenerator と同じ呼び方で、生成をサーバーに任せる"""
+
+    def __init__(self, addr=SERVER_ADDR, timeout=None):
+        self.addr = addr
+        self.timeout = timeout
+
+    def alive(self, timeout=0.5):
+        try:
+            conn = http.client.HTTPConnection(*self.addr, timeout=timeout)
+            conn.request("GET", "/health")
+            ok = conn.getresponse().status == 200
+            conn.close()
+            return ok
+        except OSError:
+            return False
+
+    def iter_generate(self, prompts, tokens=1024, batch_size=DEFAULT_BATCH_SIZE, do_sample=True,
+                      seed=None, priority=PRIORITY_PLAYBACK):
+        body = json.dumps({
+            "prompts": list(prompts), "tokens": tokens, "batch_size": batch_size,
+            "do_sample": do_sample, "seed": seed, "priority": priority,
+        }).encode("utf-8")
+        conn = http.client.HTTPConnection(*self.addr, timeout=self.timeout)
+        try:
+            conn.request("POST", "/generate", body, {"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            if resp.status != 200:
+                try:
+                    reason = json.loads(resp.read())["error"]
+                except (ValueError, KeyError, TypeError):
+                    reason = resp.reason
+                raise RuntimeError(f"MusicGen サーバーエラー {resp.status}: {reason}")
+            for _ in prompts:
+                header = resp.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    raise RuntimeError("MusicGen サーバーとの接続が切れました")
+                n, rate = FRAME_HEADER.unpack(header)
+                if rate < 0:
+                    raise RuntimeError(resp.read(n).decode("utf-8", "replace"))
+                yield np.frombuffer(resp.read(n * 4), dtype="<f4").copy(), rate
+        finally:
+            conn.close()
+
+    def generate_batch(self, prompts, tokens=1024, batch_size=DEFAULT_BATCH_SIZE, do_sample=True,
+                       seed=None, priority=PRIORITY_PLAYBACK):
+        return list(self.iter_generate(prompts, tokens, batch_size, do_sample, seed, priority))
+
+
+def connect(addr=SERVER_ADDR, fallback=True):
+    """サーバーが動いていればクライアントを、いなければ（fallback=True なら）自前で読み込んだ生成器を返す"""
+    client = MusicGenClient(addr)
+    if client.alive():
+        print(f"🔌 MusicGen サーバー {addr[0]}:{addr[1]} に接続")
+        return client
+    if not fallback:
+        raise RuntimeError(f"MusicGen サーバー {addr[0]}:{addr[1]} に接続できません（python musicgen_server.py で起動）")
+    print("⚠️ MusicGen サーバーが見つからないため、このプロセスでモデルを読み込みます")
+    return LocalGenerator(cache=SegmentCache())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MusicGen 推論サーバー（モデルを1回だけ読み込んで常駐）")
+    parser.add_argument("--port", type=int, default=SERVER_ADDR[1])
+    parser.add_argument("--model", default=MUSICGEN_MODEL)
+    parser.add_argument("--cpu", action="store_true", help="GPU があっても CPU で動かす")
+    parser.add_argument("--quantize", action="store_true", default=CPU_QUANTIZE,
+                        help="CPU のときデコーダーを int8 に動的量子化する")
+    parser.add_argument("--threads", type=int, default=CPU_THREADS, help="CPU 推論のスレッド数")
+    parser.add_argument("--bf16-matmul", action="store_true", default=CPU_MATMUL_PRECISION == "medium",
+                        help="CPU の float32 行列積を bf16 で計算する")
+    args = parser.parse_args()
+
+    cpu_options = {"quantize": args.quantize, "threads": args.threads,
+                   "matmul_precision": "medium" if args.bf16_matmul else "highest"}
+    MusicGenServer((SERVER_ADDR[0], args.port), args.model, -1 if args.cpu else None,
+                   SegmentCache(), cpu_options).serve_forever()
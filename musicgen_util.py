@@ -0,0 +1,158 @@
+import numpy as np
+from segment_cache import cache_key
+
+# ==== 設定 ====
+MUSICGEN_MODEL = "facebook/musicgen-small"
+DEFAULT_BATCH_SIZE = 4  # 一度にモデルへ渡すプロンプト数（メモリ不足なら自動で半分にする）
+
+# CPU 推論の設定（GPU の無いマシン用。どれが速いかは python bench_musicgen.py で比べる）
+CPU_QUANTIZE = False              # デコーダーの Linear を int8 に動的量子化する
+CPU_THREADS = None                # 推論スレッド数（None なら torch の既定）
+CPU_MATMUL_PRECISION = "highest"  # "medium" にすると対応CPUで float32 の行列積を bf16 で計算する
+
+
+# メモリ不足の例外メッセージ（CUDA は "out of memory"、CPU のアロケーターは "can't allocate memory" など）
+OOM_MARKERS = ("out of memory", "can't allocate memory", "not enough memory")
+
+
+def _is_out_of_memory(e):
+    if isinstance(e, MemoryError) or type(e).__name__ == "OutOfMemoryError":
+        return True
+    message = str(e).lower()
+    return any(marker in message for marker in OOM_MARKERS)
+
+
+def _free_memory():
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+def _seed(seed):
+    try:
+        import torch
+        torch.manual_seed(seed)
+    except ImportError:
+        pass
+
+
+def model_id(pipe):
+    """キャッシュキー用のモデル名。optimize_for_cpu で出力が変わる設定（int8・bf16 行列積）も付ける"""
+    name = getattr(pipe.model, "name_or_path", "") or type(pipe.model).__name__
+    variant = getattr(pipe, "cpu_variant", "")
+    return f"{name}+{variant}" if variant else name
+
+
+def _to_mono(audio):
+    return np.squeeze(np.asarray(audio["audio"], dtype=np.float32))
+
+
+def generate_batch(pipe, prompts, tokens=1024, batch_size=DEFAULT_BATCH_SIZE, do_sample=True,
+                   seed=None, cache=None):
+    """複数プロンプトをまとめて text-to-audio パイプラインに通し、
+    [(音声 float32 1次元, サンプリングレート)] をプロンプトと同じ順で返す。
+    メモリ不足のときはバッチを半分にして同じところからやり直す（最小1）。
+    seed を指定するとバッチごとにシードを固定し、cache（SegmentCache）があれば
+    同じ条件の生成済みセグメントはディスクから読む（シード無しはキャッシュしない）"""
+    return list(iter_generate(pipe, prompts, tokens, batch_size, do_sample, seed, cache))
+
+
+def iter_generate(pipe, prompts, tokens=1024, batch_size=DEFAULT_BATCH_SIZE, do_sample=True,
+                  seed=None, cache=None):
+    """generate_batch と同じだが、バッチが終わるたびにプロンプト順で (音声, レート) を yield する
+    （batch_size=1 なら1ステージ生成するごとに受け取れる）。
+    同じシードでも一緒に生成したプロンプトが違えば結果が変わるので、キャッシュはバッチ単位で引く
+    （バッチ全部がそろっているときだけ使い、1つでも欠けていればバッチごと生成し直す）"""
+    use_cache = cache is not None and seed is not None
+    model = model_id(pipe) if use_cache else None
+    batch_size = max(1, batch_size)
+    i = 0
+    while i < len(prompts):
+        chunk = prompts[i:i + batch_size]
+        keys = [cache_key(model, prompt, seed, tokens, batch=chunk, index=k, do_sample=do_sample)
+                for k, prompt in enumerate(chunk)] if use_cache else []
+        cached = [cache.get(key) for key in keys]
+        if keys and all(r is not None for r in cached):
+            print(f"💾 キャッシュから {len(chunk)} セグメントを読み込み")
+            yield from cached
+            i += len(chunk)
+            continue
+        if seed is not None:
+            _seed(seed)
+        try:
+            out = pipe(list(chunk), batch_size=len(chunk),
+                       forward_params={"do_sample": do_sample, "max_new_tokens": tokens})
+        except (RuntimeError, MemoryError) as e:
+            if batch_size > 1 and _is_out_of_memory(e):
+                batch_size //= 2
+                _free_memory()
+                print(f"⚠️ メモリ不足 → バッチサイズを {batch_size} に下げて再試行")
+                continue
+            raise
+        if isinstance(out, dict):
+            out = [out]
+        for k, audio in enumerate(out):
+            if isinstance(audio, list):
+                audio = audio[0]
+            result = (_to_mono(audio), audio["sampling_rate"])
+            if keys:
+                cache.put(keys[k], result[0], result[1], model=model, prompt=chunk[k], batch=list(chunk),
+                          index=k, seed=seed, max_new_tokens=tokens, do_sample=do_sample)
+            yield result
+        i += len(chunk)
+
+
+# ==== モデルを自分で読み込んで生成する ====
+def optimize_for_cpu(pipe, quantize=CPU_QUANTIZE, threads=CPU_THREADS, matmul_precision=CPU_MATMUL_PRECISION):
+    """CPU 向けにスレッド数・行列積の精度を設定し、必要ならデコーダーを int8 に量子化する（モデルは書き換わる）。
+    トークン生成ループの時間はほぼデコーダーなので、テキストエンコーダーと EnCodec は float32 のまま"""
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+    torch.set_float32_matmul_precision(matmul_precision)
+    # 量子化・行列積の精度で出力が変わるので、キャッシュを分けられるよう印を付けておく（スレッド数は結果に関係しない）
+    variant = []
+    if quantize or getattr(pipe, "cpu_variant", "").startswith("int8"):
+        variant.append("int8")
+    if matmul_precision != "highest":
+        variant.append(f"matmul-{matmul_precision}")
+    pipe.cpu_variant = "+".join(variant)
+    if quantize:
+        model = pipe.model
+        if hasattr(model, "decoder"):
+            model.decoder = torch.ao.quantization.quantize_dynamic(model.decoder, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            pipe.model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return pipe
+
+
+def load_pipeline(model=MUSICGEN_MODEL, device=None, cpu_options=None):
+    """text-to-audio パイプラインを読み込む（transformers/torch はここで初めて import する）。
+    CPU のときは cpu_options（optimize_for_cpu の引数。None なら CPU_* の設定）で最適化する"""
+    import torch
+    from transformers import pipeline
+    if device is None:
+        device = 0 if torch.cuda.is_available() else -1
+    pipe = pipeline("text-to-audio", model=model, device=device)
+    if device == -1:
+        optimize_for_cpu(pipe, **(cpu_options or {}))
+    return pipe
+
+
+class LocalGenerator:
+    """推論サーバーが無いときの代わり。MusicGenClient と同じ呼び方でこのプロセス内で生成する"""
+
+    def __init__(self, model=MUSICGEN_MODEL, device=None, cache=None, cpu_options=None):
+        self.pipe = load_pipeline(model, device, cpu_options)
+        self.cache = cache
+
+    def iter_generate(self, prompts, tokens=1024, batch_size=DEFAULT_BATCH_SIZE, do_sample=True,
+                      seed=None, priority=None):
+        return iter_generate(self.pipe, prompts, tokens, batch_size, do_sample, seed, self.cache)
+
+    def generate_batch(self, prompts, tokens=1024, batch_size=DEFAULT_BATCH_SIZE, do_sample=True,
+                       seed=None, priority=None):
+        return list(self.iter_generate(prompts, tokens, batch_size, do_sample, seed, priority))
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import sys
+import threading
+import numpy as np
+from audio_dsp import RESAMPLER, resample
+from audio_engine import PLAYBACK_RATE, PresetLoop
+
+# ==== 設定 ====
+# デコード済み PCM（再生レートの float32 モノラル）の置き場所。WAV より新しければ次回からはメモリマップするだけ
+PCM_CACHE_DIR = "output/cache/pcm"
+# デコード・リサンプルの方式が変わったら上げる（ファイル名に入るので古い PCM は読まれずに作り直される）
+PCM_FORMAT_VERSION = 2
+
+
+class PresetPool:
+    """プリセットループを1回だけデコードして PresetLoop として持ち続ける。
+    ループの切り替え時にはディスクI/Oも大きなメモリ確保も起きない"""
+
+    def __init__(self, rate=PLAYBACK_RATE, fade_len=3000, cache_dir=PCM_CACHE_DIR):
+        self.rate = rate
+        self.fade_len = fade_len
+        self.cache_dir = cache_dir
+        self.loops = {}
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _pcm_path(self, path):
+        digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:8]
+        name = os.path.splitext(os.path.basename(path))[0]
+        tag = f"v{PCM_FORMAT_VERSION}-{RESAMPLER}"
+        return os.path.join(self.cache_dir, f"{name}_{digest}_{self.rate}_{tag}.f32")
+
+    def _load_pcm(self, path):
+        pcm_path = self._pcm_path(path)
+        if not os.path.exists(pcm_path) or os.path.getmtime(pcm_path) < os.path.getmtime(path):
+            import soundfile as sf
+            data, rate = sf.read(path, dtype="float32", always_2d=True)
+            mono = data.mean(axis=1, dtype=np.float32) if data.shape[1] > 1 else data[:, 0]
+            mono = resample(mono, rate, self.rate)
+            tmp = pcm_path + ".tmp"
+            mono.astype("<f4").tofile(tmp)
+            os.replace(tmp, pcm_path)
+            self._remove_stale(path, pcm_path)
+        if os.path.getsize(pcm_path) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return np.memmap(pcm_path, dtype="<f4", mode="r")
+
+    def _remove_stale(self, path, keep):
+        """同じ WAV を同じレートで古い方式で変換した PCM を消す"""
+        prefix = os.path.basename(self._pcm_path(path)).rsplit("_", 1)[0]
+        for fname in os.listdir(self.cache_dir):
+            stale = os.path.join(self.cache_dir, fname)
+            if fname.startswith(prefix) and fname.endswith(".f32") and stale != keep:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass  # 別プロセスがメモリマップ中など。次回また消す
+
+    def get(self, path):
+        with self.lock:
+            loop = self.loops.get(path)
+            if loop is None:
+                loop = self.loops[path] = PresetLoop(self._load_pcm(path), self.fade_len)
+            return loop
+
+    def loops_for(self, paths):
+        """読めたループだけ返す（無いファイルは飛ばす）"""
+        loops = []
+        for path in paths:
+            try:
+                loops.append(self.get(path))
+            except (OSError, RuntimeError) as e:
+                print(f"⚠️ プリセット {path} を読めません: {e}")
+        return loops
+
+    def preload(self, paths):
+        self.loops_for(paths)
+        return len(self.loops)
+
+    def nbytes(self):
+        return sum(loop.data.nbytes + loop.head.nbytes + loop.tail.nbytes for loop in self.loops.values())
+
+
+if __name__ == "__main__":
+    # python preset_pool.py output/loop_*.wav  → デコード済み PCM を作っておく
+    pool = PresetPool()
+    n = pool.preload(sys.argv[1:])
+    print(f"✅ {n} ループ / {pool.nbytes() / 1024**2:.1f} MB（{pool.rate} Hz float32）")
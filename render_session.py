@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import random
+import time
+import zlib
+import numpy as np
+import app
+import app2
+from audio_engine import PLAYBACK_RATE, AudioEngine
+from musicgen_util import DEFAULT_BATCH_SIZE
+from session_clock import VirtualClock
+
+# ==== 設定 ====
+SESSION_PATH = "output/session.wav"
+TOKENS_PER_SEC = 50  # MusicGen は1秒あたり50トークン
+SIM_RTF = 0.5        # 疑似生成の速さ（生成にかかる秒 / できる音声の秒。GPU で musicgen-small くらい）
+
+
+# ==== 出力デバイスの代わり ====
+class SessionRecorder:
+    """エンジンをブロック単位で回して、混ぜた音声を WAV に書く（path=None なら捨てる＝null sink）。
+    再生ループが書き込み待ちで duration 秒を少し過ぎても、書き出すのは duration 秒まで"""
+
+    def __init__(self, engine, path=None, duration=None):
+        self.engine = engine
+        self.block = np.zeros(engine.block_size, dtype=np.float32)
+        self.frames = 0
+        self.limit = None if duration is None else int(duration * engine.rate)
+        self.file = None
+        if path:
+            import soundfile as sf
+            self.file = sf.SoundFile(path, "w", engine.rate, 1, "PCM_16")
+
+    def advance_to(self, t):
+        """t 秒ぶんまで鳴らす（VirtualClock の on_advance）"""
+        while self.frames < t * self.engine.rate:
+            self.engine.render(self.block)
+            n = len(self.block) if self.limit is None else max(0, min(len(self.block), self.limit - self.frames))
+            if self.file is not None and n:
+                self.file.write(np.clip(self.block[:n], -1, 1))
+            self.frames += len(self.block)
+
+    def rendered(self):
+        """書き出した（null sink なら鳴らした）秒数"""
+        frames = self.frames if self.limit is None else min(self.frames, self.limit)
+        return frames / self.engine.rate
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+# ==== 生成器 ====
+class SimGenerator:
+    """MusicGen の代わり。プロンプトとシードごとに決まった音程のサイン波を返す。
+    1バッチごとに「音声の長さ × rtf」秒だけ仮想時計を進めるので、生成待ちやプリセットへの切り替えもそのまま再現される"""
+
+    def __init__(self, clock, rtf=SIM_RTF, rate=PLAYBACK_RATE):
+        self.clock = clock
+        self.rtf = rtf
+        self.rate = rate
+
+    def _tone(self, prompt, seconds, seed):
+        semitone = zlib.crc32(f"{prompt}:{seed}".encode("utf-8")) % 24
+        t = np.arange(int(seconds * self.rate), dtype=np.float32) / np.float32(self.rate)
+        return (0.2 * np.sin(np.float32(2 * np.pi * 110 * 2 ** (semitone / 12)) * t)).astype(np.float32)
+
+    def iter_generate(self, prompts, tokens=1024, batch_size=DEFAULT_BATCH_SIZE, do_sample=True,
+                      seed=None, priority=None):
+        seconds = tokens / TOKENS_PER_SEC
+        for i in range(0, len(prompts), batch_size):
+            self.clock.sleep(seconds * self.rtf)
+            for prompt in prompts[i:i + batch_size]:
+                yield self._tone(prompt, seconds, seed), self.rate
+
+    def generate_batch(self, prompts, tokens=1024, batch_size=DEFAULT_BATCH_SIZE, do_sample=True,
+                       seed=None, priority=None):
+        return list(self.iter_generate(prompts, tokens, batch_size, do_sample, seed, priority))
+
+
+class TimedGenerator:
+    """本物の生成器（推論サーバー・自前のモデル）をヘッドレスで使うとき用。
+    生成中は仮想時計が止まるので、かかった実時間を後から仮想時計に足す"""
+
+    def __init__(self, generator, clock):
+        self.generator = generator
+        self.clock = clock
+
+    def iter_generate(self, *args, **kwargs):
+        results = iter(self.generator.iter_generate(*args, **kwargs))
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(results)
+            except StopIteration:
+                return
+            self.clock.sleep(time.perf_counter() - t0)
+            yield item
+
+    def generate_batch(self, *args, **kwargs):
+        return list(self.iter_generate(*args, **kwargs))
+
+
+# ==== セッションを描く ====
+APPS = {"app": app, "app2": app2}
+
+
+def render(minutes, path=SESSION_PATH, real_musicgen=False, rtf=SIM_RTF, seed=0, player=app2):
+    """player（app か app2 モジュール）の再生ループを仮想時計で minutes 分ぶん回し、
+    音声を path、タイムラインを .json に書く"""
+    random.seed(seed)
+    engine = AudioEngine(PLAYBACK_RATE)
+    recorder = SessionRecorder(engine, path, minutes * 60)
+    clock = VirtualClock(recorder.advance_to)
+    if real_musicgen:
+        generator = TimedGenerator(player.connect(), clock)
+    else:
+        generator = SimGenerator(clock, rtf)
+
+    t0 = time.perf_counter()
+    try:
+        stats = player.main(engine, clock, generator, minutes * 60)
+    finally:
+        recorder.close()
+    wall = time.perf_counter() - t0
+    rendered = recorder.rendered()
+    summary = {
+        "app": player.__name__,
+        "minutes": minutes,
+        "rendered_sec": round(rendered, 3),
+        "wall_sec": round(wall, 3),
+        "speed": round(rendered / wall, 1),
+        "generator": "musicgen" if real_musicgen else f"sim(rtf={rtf})",
+        "seed": seed,
+        "stats": stats,
+        "events": player.timeline,
+    }
+    if path:
+        with open(os.path.splitext(path)[0] + ".json", "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=1)
+    print(f"✅ {rendered / 60:.1f} 分を {wall:.1f} 秒で描きました（{summary['speed']}x）"
+          f" / イベント {len(player.timeline)} 件 / underruns={stats['underruns']}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="app / app2 の再生ループを出力デバイス無し・仮想時計で実時間より速く回す")
+    parser.add_argument("--app", choices=list(APPS), default="app2", help="回す再生ループ")
+    parser.add_argument("--minutes", type=float, help="描く長さ（分。省略時は感情を一周）")
+    parser.add_argument("--out", default=SESSION_PATH, help="WAV の書き出し先（タイムラインは同名の .json）")
+    parser.add_argument("--null", action="store_true", help="音声を書き出さない（計測用）")
+    parser.add_argument("--musicgen", action="store_true", help="疑似生成でなく本物の MusicGen を使う")
+    parser.add_argument("--rtf", type=float, default=SIM_RTF, help="疑似生成の速さ（生成秒 / 音声秒）")
+    parser.add_argument("--interval", type=float, help="感情の切り替え間隔（秒。省略時はそのアプリの EMOTION_INTERVAL）")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    player = APPS[args.app]
+    if args.interval:
+        player.EMOTION_INTERVAL = args.interval
+    minutes = args.minutes or player.EMOTION_INTERVAL * len(player.emotions) / 60
+    render(minutes, None if args.null else args.out, args.musicgen, args.rtf, args.seed, player)
@@ -0,0 +1,168 @@
+import os
+import sys
+import numpy as np
+from hr_log import EMOTIONS, EMOTION_CODES, PartitionedLog
+
+# ==== 集計ファイル形式 ====
+# logs/<デバイス名>/rollup/<秒>.rlp : ヘッダー(16バイト) + 固定長レコード（開始時刻の昇順）
+# 最後のレコードは集計中の区間（書き出しのたびに上書きされる）
+MAGIC = b"HRROLL1\0"
+HEADER_SIZE = 16
+ROLLUP_INTERVALS = [60, 300, 3600]  # 1分 / 5分 / 1時間
+
+ROLLUP_DTYPE = np.dtype([
+    ("start", "<f8"),
+    ("count", "<u4"),
+    ("hr_mean", "<f4"),
+    ("hr_min", "<u2"),
+    ("hr_max", "<u2"),
+    ("rmssd_mean", "<f4"),
+    ("emotion_counts", "<u4", (len(EMOTIONS),)),
+])
+
+
+def rollup_path(directory, interval):
+    return os.path.join(directory, "rollup", f"{interval}.rlp")
+
+
+# ==== 1つの解像度の集計 ====
+class RollupFile:
+    """区間ごとの平均/最小/最大HR・平均RMSSD・感情の件数を追記で保存する"""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE:
+            with open(path, "wb") as f:
+                f.write(MAGIC + np.array([ROLLUP_DTYPE.itemsize, interval], dtype="<u4").tobytes())
+        self.f = open(path, "r+b")
+        n = (os.path.getsize(path) - HEADER_SIZE) // ROLLUP_DTYPE.itemsize
+        self.current = None
+        self.n_final = n
+        if n:
+            # 前回の集計中区間を読み戻して続きから数える
+            self.f.seek(HEADER_SIZE + (n - 1) * ROLLUP_DTYPE.itemsize)
+            self.current = np.frombuffer(self.f.read(ROLLUP_DTYPE.itemsize), dtype=ROLLUP_DTYPE).copy().reshape(())
+            self.n_final = n - 1
+        self.sum_hr = 0.0
+        self.sum_rmssd = 0.0
+        if self.current is not None:
+            self.sum_hr = float(self.current["hr_mean"]) * int(self.current["count"])
+            self.sum_rmssd = float(self.current["rmssd_mean"]) * int(self.current["count"])
+
+    def _write_current(self):
+        self.current["hr_mean"] = self.sum_hr / self.current["count"]
+        self.current["rmssd_mean"] = self.sum_rmssd / self.current["count"]
+        self.f.seek(HEADER_SIZE + self.n_final * ROLLUP_DTYPE.itemsize)
+        self.f.write(self.current.tobytes())
+
+    def add(self, timestamp, heart_rate, rmssd, emotion_code):
+        start = timestamp // self.interval * self.interval
+        cur = self.current
+        if cur is not None and start < cur["start"]:
+            # 区間をさかのぼる行は集計しない（時刻は単調増加の前提）
+            return
+        if cur is None or start > cur["start"]:
+            if cur is not None:
+                self._write_current()
+                self.n_final += 1
+            cur = self.current = np.zeros((), dtype=ROLLUP_DTYPE)
+            cur["start"] = start
+            cur["hr_min"] = heart_rate
+            cur["hr_max"] = heart_rate
+            self.sum_hr = 0.0
+            self.sum_rmssd = 0.0
+        cur["count"] += 1
+        cur["hr_min"] = min(int(cur["hr_min"]), heart_rate)
+        cur["hr_max"] = max(int(cur["hr_max"]), heart_rate)
+        cur["emotion_counts"][emotion_code] += 1
+        self.sum_hr += heart_rate
+        self.sum_rmssd += rmssd
+
+    def flush(self):
+        if self.current is not None:
+            self._write_current()
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class RollupWriter:
+    """取り込み時に全解像度の集計を同時に更新する（生ログの writer と並べて使う）"""
+
+    def __init__(self, directory, intervals=ROLLUP_INTERVALS):
+        self.files = [RollupFile(rollup_path(directory, i), i) for i in intervals]
+
+    def append_many(self, rows):
+        for timestamp, heart_rate, _, rmssd, emotion in rows:
+            code = EMOTION_CODES.get(emotion, 0)
+            for f in self.files:
+                f.add(timestamp, int(heart_rate), float(rmssd), code)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+    def fsync(self):
+        for f in self.files:
+            f.flush()
+            os.fsync(f.f.fileno())
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+# ==== 読み込み ====
+def read_rollup(directory, interval, t_from=None, t_to=None):
+    """[t_from, t_to] に掛かる区間のレコードを返す（メモリマップ上のビュー）"""
+    path = rollup_path(directory, interval)
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=ROLLUP_DTYPE)
+    n = max(os.path.getsize(path) - HEADER_SIZE, 0) // ROLLUP_DTYPE.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=ROLLUP_DTYPE)
+    records = np.memmap(path, dtype=ROLLUP_DTYPE, mode="r", offset=HEADER_SIZE, shape=(n,))
+    starts = records["start"]
+    lo = 0 if t_from is None else int(np.searchsorted(starts, t_from - interval, side="right"))
+    hi = n if t_to is None else int(np.searchsorted(starts, t_to, side="right"))
+    return records[lo:hi]
+
+
+def pick_interval(span, max_points, intervals=ROLLUP_INTERVALS):
+    """span 秒を max_points 点以下で描ける最も細かい解像度（どれも超えるなら最も粗いもの）"""
+    for interval in sorted(intervals):
+        if span / interval <= max_points:
+            return interval
+    return max(intervals)
+
+
+def rebuild(directory, intervals=ROLLUP_INTERVALS):
+    """生ログから集計を作り直す（取り込み済みの過去ログ用）"""
+    for interval in intervals:
+        path = rollup_path(directory, interval)
+        if os.path.exists(path):
+            os.remove(path)
+    writer = RollupWriter(directory, intervals)
+    log = PartitionedLog(directory)
+    count = 0
+    for name, path in log.partitions():
+        records = log.reader(name, path).records
+        for rec in records:
+            code = int(rec["emotion"])
+            for f in writer.files:
+                f.add(float(rec["timestamp"]), int(rec["heart_rate"]), float(rec["rmssd"]), code)
+        count += len(records)
+    writer.close()
+    return count
+
+
+if __name__ == "__main__":
+    # python rollup.py logs/coospo
+    if len(sys.argv) != 2:
+        print("使い方: python rollup.py <ログDir>")
+        sys.exit(1)
+    print(f"✅ {rebuild(sys.argv[1])} 行から集計を作り直しました")
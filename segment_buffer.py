@@ -0,0 +1,93 @@
+import collections
+import threading
+from session_clock import RealClock
+
+# ==== 設定 ====
+MAX_BUFFER_SAMPLES = 32000 * 600  # ためておく音声の上限（全感情の合計。32kHz で10分 ≒ float32 77MB）
+
+
+class SegmentBuffer:
+    """生成した音声を感情ごとのキュー（deque）にためる。
+    get/put は Condition で待つので、積まれた・空いた瞬間に相手が起きる。
+    合計が capacity サンプルを超える put は空くまで待つ（背圧）。
+    待ち時間は clock（省略時は実時間）で数えるので、ヘッドレス再生の仮想時計でも動く"""
+
+    def __init__(self, emotions, emotion=None, capacity=MAX_BUFFER_SAMPLES, clock=None):
+        self.cond = threading.Condition()
+        self.clock = clock or RealClock()
+        self.version = 0  # notify するたびに増える（wait() が起きる目印）
+        self.queues = {e: collections.deque() for e in emotions}
+        self.sizes = {e: 0 for e in emotions}
+        self.total = 0
+        self.capacity = capacity
+        self.emotion = emotion or emotions[0]
+        self.running = True
+        self.rate = None
+
+    def put(self, seg, rate=None, emotion=None, timeout=None):
+        """emotion（省略時は今の感情）のキューへ積む。timeout 秒待っても空かなければ False"""
+        emotion = emotion or self.emotion
+        with self.cond:
+            # その感情のキューが空なら上限を超えても積む（他の感情の先読みで詰まらないように）
+            ok = self.clock.wait_for(self.cond, lambda: (self.total + len(seg) <= self.capacity
+                                                         or not self.queues[emotion] or not self.running),
+                                     timeout)
+            if not ok or not self.running:
+                return False
+            self.queues[emotion].append(seg)
+            self.sizes[emotion] += len(seg)
+            self.total += len(seg)
+            if rate is not None:
+                self.rate = rate
+            self._notify()
+            return True
+
+    def get(self, emotion=None, timeout=None):
+        """emotion（省略時は今の感情）のキューの先頭を取り出す。timeout 秒待っても無ければ None（0 なら待たない）"""
+        with self.cond:
+            if not self.clock.wait_for(self.cond, lambda: self.queues[emotion or self.emotion] or not self.running,
+                                       timeout):
+                return None
+            queue = self.queues[emotion or self.emotion]
+            if not queue:
+                return None
+            seg = queue.popleft()
+            self.sizes[emotion or self.emotion] -= len(seg)
+            self.total -= len(seg)
+            self._notify()
+            return seg
+
+    def _notify(self):
+        self.version += 1
+        self.cond.notify_all()
+
+    def pop(self, emotion=None):
+        return self.get(emotion, timeout=0)
+
+    def clear(self, emotion=None):
+        """その感情のキューを丸ごと捨てる（新しい deque に差し替えるだけ）"""
+        emotion = emotion or self.emotion
+        with self.cond:
+            self.queues[emotion] = collections.deque()
+            self.total -= self.sizes[emotion]
+            self.sizes[emotion] = 0
+            self._notify()
+
+    def wait(self, timeout=None):
+        """誰かが積む・取り出す・notify() するまで待つ"""
+        with self.cond:
+            version = self.version
+            self.clock.wait_for(self.cond, lambda: self.version != version or not self.running, timeout)
+
+    def notify(self):
+        """感情の切り替えなど、バッファの外の状態が変わったことを待っている側に知らせる"""
+        with self.cond:
+            self._notify()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self._notify()
+
+    def __len__(self):
+        return len(self.queues[self.emotion])
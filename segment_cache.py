@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+# ==== 設定 ====
+CACHE_DIR = "output/cache"
+CACHE_MAX_BYTES = 2 * 1024**3  # これを超えたら最後に使ってから長いものから消す
+
+
+def cache_key(model, prompt, seed, max_new_tokens, batch=None, index=0, **sampling):
+    """生成条件（モデル・プロンプト・シード・トークン数・サンプリング設定）から決まるキー。
+    サンプリングの乱数はバッチ全体で共有されるので、一緒に生成したプロンプト（batch）と
+    その中の位置（index）もキーに入れる（batch=None なら1つだけで生成したもの）"""
+    params = {
+        "model": model,
+        "prompt": prompt,
+        "batch": list(batch) if batch is not None else [prompt],
+        "index": index,
+        "seed": seed,
+        "max_new_tokens": max_new_tokens,
+        "sampling": sampling,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# ==== 生成済みセグメントのキャッシュ ====
+class SegmentCache:
+    """<キー>.npy（float32 PCM）と <キー>.json（メタデータ）で保存する。
+    使うたびに更新日時を付け直し、容量を超えたら更新日時の古い順に消す（LRU）"""
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.sizes = {}
+        for fname in os.listdir(directory):
+            key, ext = os.path.splitext(fname)
+            if ext in (".npy", ".json"):
+                self.sizes[key] = self.sizes.get(key, 0) + os.path.getsize(os.path.join(directory, fname))
+        self.total = sum(self.sizes.values())
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def get(self, key):
+        """(音声, サンプリングレート) を返す。無ければ None"""
+        with self.lock:
+            if key not in self.sizes:
+                return None
+            try:
+                with open(self._path(key, ".json"), encoding="utf-8") as f:
+                    meta = json.load(f)
+                audio = np.load(self._path(key, ".npy"))
+            except (OSError, ValueError):
+                self._remove(key)
+                return None
+            now = time.time()
+            for ext in (".npy", ".json"):
+                os.utime(self._path(key, ext), (now, now))
+            return audio, meta["sampling_rate"]
+
+    def put(self, key, audio, sampling_rate, **meta):
+        with self.lock:
+            if key in self.sizes:
+                self._remove(key)
+            np.save(self._path(key, ".npy"), np.asarray(audio, dtype=np.float32))
+            meta = dict(meta, sampling_rate=sampling_rate, created=time.time())
+            tmp = self._path(key, ".json.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp, self._path(key, ".json"))
+            self.sizes[key] = os.path.getsize(self._path(key, ".npy")) + os.path.getsize(self._path(key, ".json"))
+            self.total += self.sizes[key]
+            self._evict(keep=key)
+
+    def _remove(self, key):
+        for ext in (".npy", ".json"):
+            try:
+                os.remove(self._path(key, ext))
+            except FileNotFoundError:
+                pass
+        self.total -= self.sizes.pop(key, 0)
+
+    def _evict(self, keep=None):
+        if self.total <= self.max_bytes:
+            return
+        def last_used(key):
+            try:
+                return os.path.getmtime(self._path(key, ".npy"))
+            except OSError:
+                return 0.0
+        for key in sorted(self.sizes, key=last_used):
+            if self.total <= self.max_bytes:
+                break
+            if key != keep:
+                self._remove(key)
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+if __name__ == "__main__":
+    # python segment_cache.py [上限MB]  → キャッシュの状況を表示（上限を指定したらそこまで削る）
+    cache = SegmentCache()
+    if len(sys.argv) == 2:
+        cache.max_bytes = int(float(sys.argv[1]) * 1024**2)
+        with cache.lock:
+            cache._evict()
+    print(f"📦 {len(cache)} セグメント / {cache.total / 1024**2:.1f} MB（上限 {cache.max_bytes / 1024**2:.0f} MB）")
@@ -0,0 +1,72 @@
+import bisect
+import numpy as np
+from hr_log import EMOTIONS
+
+# ==== 設定 ====
+MAX_GAP_SEC = 120  # これ以上データが途切れたら同じ感情でも別の区間にする
+
+
+# ==== 感情の連続区間（ランレングス） ====
+class SegmentTracker:
+    """同じ感情が続く区間 (開始, 終了, 感情コード) を、行が届くたびに末尾だけ更新して保持する"""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.codes = []
+        self.last_ts = None
+
+    def extend(self, timestamps, codes):
+        """時刻順の新しい行を取り込む"""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        codes = np.asarray(codes)
+        if not len(timestamps):
+            return
+        # チャンク内で感情が変わる位置・データが途切れる位置で区切る
+        breaks = np.flatnonzero((np.diff(codes) != 0) | (np.diff(timestamps) > MAX_GAP_SEC)) + 1
+        firsts = np.concatenate([[0], breaks])
+        lasts = np.concatenate([breaks - 1, [len(timestamps) - 1]])
+        for a, b in zip(firsts.tolist(), lasts.tolist()):
+            start, end, code = float(timestamps[a]), float(timestamps[b]), int(codes[a])
+            if (self.codes and self.codes[-1] == code
+                    and start - self.ends[-1] <= MAX_GAP_SEC):
+                # 前回の最後の区間の続き
+                self.ends[-1] = end
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+                self.codes.append(code)
+        self.last_ts = float(timestamps[-1])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def query(self, t_from=None, t_to=None, min_duration=0):
+        """[t_from, t_to] に掛かる区間を、min_duration 秒未満の区間を直前の区間へ吸収して返す"""
+        lo = 0 if t_from is None else bisect.bisect_left(self.ends, t_from)
+        hi = len(self.starts) if t_to is None else bisect.bisect_right(self.starts, t_to)
+        merged = []
+        for i in range(lo, hi):
+            start, end, code = self.starts[i], self.ends[i], self.codes[i]
+            if merged:
+                prev = merged[-1]
+                contiguous = start - prev[1] <= MAX_GAP_SEC
+                if contiguous and (prev[2] == code or end - start < min_duration):
+                    prev[1] = end
+                    continue
+            merged.append([start, end, code])
+        return [{"start": s, "end": e, "emotion": EMOTIONS[c]} for s, e, c in merged]
+
+    def bounded(self, t_from=None, t_to=None, min_duration=0, max_segments=None):
+        """区間数が max_segments 程度に収まるよう、必要なら最短時間を広げて返す（実際に使った値も返す）。
+        データの途切れをまたいでは結合しないので、途切れが多いとそれより多くなることがある"""
+        segments = self.query(t_from, t_to, min_duration)
+        if max_segments and len(segments) > max_segments:
+            span = segments[-1]["end"] - segments[0]["start"]
+            min_duration = max(min_duration, span / max_segments)
+            while True:
+                segments = self.query(t_from, t_to, min_duration)
+                if len(segments) <= max_segments or min_duration >= span:
+                    break
+                min_duration *= 2
+        return segments, min_duration
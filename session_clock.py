@@ -0,0 +1,112 @@
+import threading
+import time
+from audio_engine import BLOCK_SIZE, PLAYBACK_RATE
+
+
+class RealClock:
+    """ふつうの時計（実時間）。再生ループはこれか VirtualClock を通して時刻を見て待つ"""
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait_for(self, cond, predicate, timeout=None):
+        """cond を握ったまま呼ぶ。Condition.wait_for と同じ"""
+        return cond.wait_for(predicate, timeout)
+
+    def start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def join(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class VirtualClock:
+    """仮想時計（ヘッドレス再生用）。参加しているスレッドが全員 sleep に入ったら、
+    一番早く起きるスレッドの時刻まで一気に時間を進める。進めた分の音声は on_advance(t) で描く。
+    誰かが動いている間は時間が止まっているので、実時間にかかわらず毎回同じ順に進む"""
+
+    def __init__(self, on_advance=None, poll=BLOCK_SIZE / PLAYBACK_RATE):
+        self.t = 0.0
+        self.cond = threading.Condition()
+        self.members = 0      # 参加スレッド数
+        self.deadlines = []   # sleep 中のスレッドの起きる時刻
+        self.on_advance = on_advance
+        self.poll = poll      # wait_for で条件を見直す間隔（仮想秒）
+        self.closed = False
+
+    def now(self):
+        return self.t
+
+    def _advance(self):
+        if self.closed or not self.deadlines or len(self.deadlines) < self.members:
+            return
+        t = min(self.deadlines)
+        if t > self.t:
+            if self.on_advance is not None:
+                self.on_advance(t)
+            self.t = t
+        self.cond.notify_all()
+
+    def sleep(self, seconds):
+        with self.cond:
+            if self.closed:
+                return
+            deadline = self.t + max(seconds, 0)
+            self.deadlines.append(deadline)
+            self._advance()
+            while self.t < deadline and not self.closed:
+                self.cond.wait()
+            self.deadlines.remove(deadline)
+
+    def wait_for(self, cond, predicate, timeout=None):
+        """cond を握ったまま呼ぶ。predicate が真になるか timeout（仮想秒）が過ぎるまで poll 秒おきに見る"""
+        deadline = None if timeout is None else self.t + timeout
+        result = predicate()
+        while not result and not self.closed:
+            if deadline is not None and self.t >= deadline:
+                break
+            cond.release()
+            try:
+                self.sleep(self.poll if deadline is None else min(self.poll, deadline - self.t))
+            finally:
+                cond.acquire()
+            result = predicate()
+        return result
+
+    def join(self):
+        """呼んだスレッドを参加させる（以後このスレッドが sleep するまで時間は進まない）"""
+        with self.cond:
+            self.members += 1
+
+    def leave(self):
+        with self.cond:
+            self.members -= 1
+            self._advance()
+
+    def start_thread(self, target, *args):
+        """参加スレッドとして target を動かす（終わったら抜ける）"""
+        self.join()
+
+        def run():
+            try:
+                target(*args)
+            finally:
+                self.leave()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        """時間を止めて、待っているスレッドを全員すぐに返す"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
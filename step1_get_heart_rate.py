@@ -1,91 +1,262 @@
-import os
 import asyncio
-import csv
+import os
+import random
 import time
-import numpy as np
 from bleak import BleakClient
+from live_feed import LivePublisher
+from hr_log import PartitionedLogWriter
+from rollup import RollupWriter
+from hrv import HRVEngine, classify_emotion
+from hrm_packets import CaptureWriter, decode_packet
 
 # ==== 設定 ====
 HR_UUID = "00002a37-0000-1000-8000-00805f9b34fb"
-target_address = "E3:09:61:D7:D7:A8"  # ← あなたのCOOSPOのBLEアドレス
-log_file = "emotion_log.csv"
-rr_list = []
-
-# ==== 初回のみ：ヘッダー行を作成 ====
-if not os.path.exists(log_file):
-    with open(log_file, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(["timestamp", "heart_rate", "rr_ms", "rmssd", "emotion"])
-
-# ==== データ受信処理 ====
-def handle_heart_rate(sender, data):
-    global rr_list
-    data = list(data)
-    timestamp = time.time()
-
-    if len(data) < 2:
-        return
-
-    hr_value = data[1]
-    flags = data[0]
-    rr_values = []
-
-    # RR間隔が含まれるか確認（フラグの0x10ビット）
-    if flags & 0x10:
-        for i in range(2, len(data), 2):
-            if i + 1 < len(data):
-                rr = data[i] + (data[i + 1] << 8)
-                rr_ms = rr / 1024 * 1000
-                rr_values.append(rr_ms)
+# 同時に記録するセンサー（名前 → BLEアドレス）。名前はログの保存先と WebUI の ?device= に使う
+DEVICES = {
+    "coospo": "E3:09:61:D7:D7:A8",  # ← あなたのCOOSPOのBLEアドレス
+}
+LOG_DIR = "logs"          # logs/<名前>/<日時>.hrl に保存
+LOG_PARTITION = "hour"    # "hour" または "day" ごとにファイルを切り替える
+COMPRESS_CLOSED = False   # 切り替え時に前のファイルを gzip 圧縮する
+CAPTURE_RAW = True        # 受信した通知のバイト列を logs/<名前>/capture/ にそのまま残す（オフライン再解析用）
+LOG_BATCH_SIZE = 64       # この件数たまったら書き出す
+LOG_FLUSH_SEC = 1.0       # 最初の1件からこの秒数たったら書き出す
+FSYNC_POLICY = "interval" # "batch"=書き出し毎 / "interval"=FSYNC_INTERVAL_SEC毎 / "none"=OS任せ
+FSYNC_INTERVAL_SEC = 10.0
+# HRV指標の窓（感情分類には10拍のRMSSDを使う）
+HRV_WINDOWS = {
+    "10beats": ("beats", 10),
+    "30s": ("ms", 30_000),
+    "5min": ("ms", 300_000),
+}
+RECONNECT_MIN_SEC = 1.0   # 再接続待ちの初期値（失敗するたびに倍）
+RECONNECT_MAX_SEC = 60.0
+STATS_INTERVAL_SEC = 60   # デバイスごとの処理量・CPU時間の表示間隔
+VERBOSE = True            # パケットごとの表示（台数が多いときは False 推奨）
+
+live = LivePublisher()  # WebUI の /stream へ即時送信
+
+# ==== ログ書き込み（固定長バイナリ。CSVが必要なら python hr_log.py export で書き出す） ====
+class AsyncLogWriter:
+    """通知ハンドラからは Queue に積むだけ。書き込みタスクが件数か時間でまとめて
+    別スレッドで書き出すので、ディスクが遅くてもBLE通知の処理は止まらない"""
+
+    def __init__(self, writers, batch_size=LOG_BATCH_SIZE, flush_sec=LOG_FLUSH_SEC,
+                 fsync=FSYNC_POLICY, fsync_interval=FSYNC_INTERVAL_SEC):
+        # append_many/flush/fsync/close を持つ書き込み先（同じ行を全部に書く）
+        self.writers = writers
+        self.batch_size = batch_size
+        self.flush_sec = flush_sec
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.last_fsync = time.monotonic()
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, *row):
+        self.queue.put_nowait(row)
+
+    async def close(self):
+        """キューに残った行をすべて書き出してから閉じる"""
+        if self.task is None:
+            return
+        self.queue.put_nowait(None)
+        await self.task
+        self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            row = await self.queue.get()
+            if row is None:
+                break
+            batch = [row]
+            deadline = loop.time() + self.flush_sec
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    # 溜まっている分は待たずに取り出す（wait_for はタスクを作るので高い）
+                    row = self.queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        row = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if row is None:
+                    closing = True
+                    break
+                batch.append(row)
+            await asyncio.to_thread(self._write, batch)
+        await asyncio.to_thread(self._close)
+
+    def _write(self, batch):
+        for writer in self.writers:
+            writer.append_many(batch)
+            writer.flush()
+        now = time.monotonic()
+        if self.fsync == "batch" or (self.fsync == "interval" and now - self.last_fsync >= self.fsync_interval):
+            for writer in self.writers:
+                writer.fsync()
+            self.last_fsync = now
+
+    def _close(self):
+        for writer in self.writers:
+            if self.fsync != "none":
+                writer.fsync()
+            writer.close()
+
+
+def log_dir_for(name):
+    return os.path.join(LOG_DIR, name)
+
+
+# ==== デバイス1台分の状態 ====
+class DeviceSession:
+    """HRV状態・ログ出力・再接続・統計をデバイスごとに持つ"""
+
+    def __init__(self, name, address):
+        self.name = name
+        self.address = address
+        self.hrv_engine = HRVEngine(HRV_WINDOWS, short_window="10beats")
+        directory = log_dir_for(name)
+        # 生ログと、同じバッチで更新する1分/5分/1時間の集計（長い期間の表示用）
+        self.log_writer = AsyncLogWriter([
+            PartitionedLogWriter(directory, partition=LOG_PARTITION, compress_closed=COMPRESS_CLOSED),
+            RollupWriter(directory),
+        ])
+        self.capture_writer = AsyncLogWriter([CaptureWriter(directory, partition=LOG_PARTITION)]) if CAPTURE_RAW else None
+        # 統計
+        self.packets = 0
+        self.rows = 0
+        self.busy_sec = 0.0
+        self.connects = 0
+
+    # ==== データ受信処理 ====
+    def handle_heart_rate(self, sender, data):
+        t0 = time.perf_counter()
+        try:
+            self._handle(data)
+        finally:
+            self.packets += 1
+            self.busy_sec += time.perf_counter() - t0
+
+    def _handle(self, data):
+        timestamp = time.time()
+        if self.capture_writer is not None:
+            self.capture_writer.put(timestamp, bytes(data))
+
+        # 16bit心拍・Energy Expended のフラグに応じて RR の位置を決める
+        hr_value, rr_values = decode_packet(data)
+        if hr_value is None:
+            return
         if rr_values:
-            rr_list.extend(rr_values)
-
-    # HRV（RMSSD）計算
-    rmssd = None
-    if len(rr_list) >= 4:
-        rr_array = np.array(rr_list[-10:])
-        diff = np.diff(rr_array)
-        rmssd = np.sqrt(np.mean(diff ** 2))
-
-    # 感情分類
-    emotion = "分類不能"
-    if rmssd is not None:
-        if hr_value >= 85 and rmssd < 30:
-            emotion = "緊張系"
-        elif hr_value <= 65 and rmssd < 30:
-            emotion = "落ち込み系"
-        elif rmssd >= 30:
-            emotion = "鎮静系"
-
-    # 表示
-    print("🟢 HR:", hr_value, "bpm")
-    if rr_values:
-        print("📏 RR:", rr_values)
-    if rmssd is not None:
-        print(f"📈 RMSSD: {rmssd:.2f} → 感情: {emotion}")
-
-    # ✅ ログ追記（RRもRMSSDも取得できたときのみ）
-    if rr_values and rmssd is not None:
-        with open(log_file, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                timestamp,
-                hr_value,
-                rr_values,
-                f"{rmssd:.2f}",
-                emotion
-            ])
+            self.hrv_engine.add(rr_values)
 
-# ==== メイン処理 ====
-async def main():
-    async with BleakClient(target_address) as client:
-        print("✅ COOSPO接続成功、記録開始")
-        await client.start_notify(HR_UUID, handle_heart_rate)
+        # HRV（RMSSD ほか）は RR 追加時に差分更新済み
+        rmssd = self.hrv_engine.rmssd()
+
+        # 感情分類
+        emotion = classify_emotion(hr_value, rmssd)
+
+        # 表示
+        if VERBOSE:
+            print(f"🟢 [{self.name}] HR:", hr_value, "bpm")
+            if rr_values:
+                print(f"📏 [{self.name}] RR:", rr_values)
+            if rmssd is not None:
+                print(f"📈 [{self.name}] RMSSD: {rmssd:.2f} → 感情: {emotion}")
+                long = self.hrv_engine.metrics().get("5min")
+                if long:
+                    print(f"📊 [{self.name}] 5分: SDNN {long['sdnn']:.1f} / pNN50 {long['pnn50']:.1f}% / 平均HR {long['mean_hr']:.1f}")
+
+        # ✅ ログ追記（RRもRMSSDも取得できたときのみ）
+        if rr_values and rmssd is not None:
+            self.log_writer.put(timestamp, hr_value, rr_values, rmssd, emotion)
+            self.rows += 1
+            live.publish({
+                "device": self.name,
+                "timestamp": timestamp,
+                "heart_rate": hr_value,
+                "rmssd": round(float(rmssd), 2),
+                "emotion": emotion
+            })
+
+    # ==== 接続・再接続 ====
+    async def run(self):
+        self.log_writer.start()
+        if self.capture_writer is not None:
+            self.capture_writer.start()
+        backoff = RECONNECT_MIN_SEC
         try:
             while True:
-                await asyncio.sleep(1)
-        except KeyboardInterrupt:
-            print("🛑 終了検出 → 通知停止")
-            await client.stop_notify(HR_UUID)
+                disconnected = asyncio.Event()
+                try:
+                    async with BleakClient(self.address,
+                                           disconnected_callback=lambda _: disconnected.set()) as client:
+                        print(f"✅ [{self.name}] 接続成功、記録開始")
+                        self.connects += 1
+                        backoff = RECONNECT_MIN_SEC
+                        await client.start_notify(HR_UUID, self.handle_heart_rate)
+                        try:
+                            await disconnected.wait()
+                        except asyncio.CancelledError:
+                            print(f"🛑 [{self.name}] 終了検出 → 通知停止")
+                            await client.stop_notify(HR_UUID)
+                            raise
+                    print(f"⚠️ [{self.name}] 切断されました")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"⚠️ [{self.name}] 接続失敗: {e}")
+                # 再接続は指数バックオフ＋ゆらぎ（全台が同時に再試行しないように）
+                wait = backoff * random.uniform(0.8, 1.2)
+                print(f"🔁 [{self.name}] {wait:.1f}秒後に再接続")
+                await asyncio.sleep(wait)
+                backoff = min(backoff * 2, RECONNECT_MAX_SEC)
+        finally:
+            await self.log_writer.close()
+            if self.capture_writer is not None:
+                await self.capture_writer.close()
+            print(f"💾 [{self.name}] ログを書き出して終了")
+
+    def stats_line(self, elapsed):
+        per_packet_us = self.busy_sec / self.packets * 1e6 if self.packets else 0.0
+        return (f"📟 [{self.name}] {self.packets / elapsed:.2f} pkt/s, {self.rows / elapsed:.2f} 行/s, "
+                f"CPU {100 * self.busy_sec / elapsed:.3f}% ({per_packet_us:.0f} µs/pkt), "
+                f"接続 {self.connects} 回, 書込待ち {self.log_writer.queue.qsize()}")
+
+    def reset_stats(self):
+        self.packets = 0
+        self.rows = 0
+        self.busy_sec = 0.0
+
+
+async def report_stats(sessions):
+    last = time.monotonic()
+    while True:
+        await asyncio.sleep(STATS_INTERVAL_SEC)
+        now = time.monotonic()
+        for session in sessions:
+            print(session.stats_line(now - last))
+            session.reset_stats()
+        last = now
+
+
+# ==== メイン処理 ====
+async def main():
+    sessions = [DeviceSession(name, address) for name, address in DEVICES.items()]
+    stats_task = asyncio.create_task(report_stats(sessions))
+    try:
+        await asyncio.gather(*(session.run() for session in sessions))
+    finally:
+        stats_task.cancel()
+
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())